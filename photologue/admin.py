@@ -6,6 +6,7 @@ from datetime import timedelta
 from django import forms
 from django.contrib import admin
 from django.contrib.contenttypes import generic
+from django.utils.timezone import localtime
 from django.utils.translation import ugettext_lazy as _
 from models import *
 from admin_tweaks.actions import slow_delete_selected
@@ -113,7 +114,7 @@ class VideoAdmin(GalleryItemModelAdmin):
         return super(VideoAdmin, self).formfield_for_dbfield(db_field, **kwargs)
 
 class VideoConvertAdmin(admin.ModelAdmin):
-    list_display = ('video', 'videosize', 'status', 'the_time', 'access_date')
+    list_display = ('video', 'videosize', 'status', 'the_time', 'worker', 'attempts', 'access_date')
     list_filter = ['videosize', 'converted']
     exclude = ('time',)
     search_fields = ['video__file']
@@ -137,11 +138,28 @@ class VideoConvertAdmin(admin.ModelAdmin):
             status = "<img src=\"/static/admin/img/icon-yes.gif\" alt=\"True\" /> "
             status += _("Done") + ""
         else:
-            status = _("In progress")
+            status = _("In progress") + " %d%%" % convert.progress
+            if convert.fps:
+                status += ", %0.1f fps" % convert.fps
+            if convert.eta:
+                status += ", " + _("ETA") + " %s" % localtime(convert.eta).strftime('%H:%M:%S')
         return status + " (%0.2fM)" % (fsize/(1024*1024.))
     status.short_description = _('Status')
     status.allow_tags = True
 
+class RegenerationJobAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'status', 'created', 'started', 'finished', 'worker', 'errors')
+    list_filter = ['mediasize', 'content_type']
+    readonly_fields = ('checkpoint', 'done', 'total', 'errors')
+
+    def status(self, job):
+        if job.finished is not None:
+            return _("Done")
+        if job.started is None:
+            return _("Queued")
+        return _("In progress") + " %d%% (%d/%d)" % (job.progress(), job.done, job.total)
+    status.short_description = _('Status')
+
 class GalleryPermissionAdmin(admin.ModelAdmin):
     list_display = ('gallery', 'can_access_gallery', 'can_see_normal_size', 'can_download_full_size', 'can_download_zip',)
     list_filter = ['can_access_gallery', 'can_see_normal_size', 'can_download_full_size', 'can_download_zip']
@@ -175,7 +193,7 @@ class ImageSizeAdmin(SlowDeleteModelAdmin):
             'fields': ('name', 'width', 'height', 'quality')
         }),
         ('Options', {
-            'fields': ('upscale', 'crop', 'pre_cache', 'increment_count')
+            'fields': ('upscale', 'crop', 'pre_cache', 'increment_count', 'draft')
         }),
         ('Enhancements', {
             'fields': ('effect', 'watermark',)
@@ -225,3 +243,4 @@ admin.site.register(Watermark, WatermarkAdmin)
 admin.site.register(Video, VideoAdmin)
 admin.site.register(VideoSize, VideoSizeAdmin)
 admin.site.register(VideoConvert, VideoConvertAdmin)
+admin.site.register(RegenerationJob, RegenerationJobAdmin)
@@ -20,6 +20,46 @@ SAMPLE_IMAGE_PATH = getattr(settings, 'SAMPLE_IMAGE_PATH', os.path.join('res', '
 # Modify image file buffer size.
 MAXBLOCK = getattr(settings, 'PHOTOLOGUE_MAXBLOCK', 256 * 2 ** 10)
 
+# JPEG images decoded at reduced resolution keep at least this multiple
+# of the target size, so the final antialiased resize has enough data
+PHOTOLOGUE_DRAFT_MARGIN = getattr(settings, 'PHOTOLOGUE_DRAFT_MARGIN', 2)
+
+# Views are counted in this cache and written to the database after
+# the interval (in seconds), or when too many objects have pending views.
+# With a local memory or dummy cache each view is written directly
+PHOTOLOGUE_VIEW_COUNT_CACHE = getattr(settings, 'PHOTOLOGUE_VIEW_COUNT_CACHE', 'default')
+PHOTOLOGUE_VIEW_COUNT_INTERVAL = getattr(settings, 'PHOTOLOGUE_VIEW_COUNT_INTERVAL', 60)
+PHOTOLOGUE_VIEW_COUNT_MAX_PENDING = getattr(settings, 'PHOTOLOGUE_VIEW_COUNT_MAX_PENDING', 100)
+# Views not flushed within this time (in seconds) are lost
+PHOTOLOGUE_VIEW_COUNT_TIMEOUT = getattr(settings, 'PHOTOLOGUE_VIEW_COUNT_TIMEOUT', 24 * 60 * 60)
+
+# Size definitions are reloaded by every process when the generation
+# stamp in this cache changes, use a cache shared by all processes.
+# A local memory or dummy cache works for a single process only, with
+# more processes they keep using the old sizes
+PHOTOLOGUE_SIZE_CACHE = getattr(settings, 'PHOTOLOGUE_SIZE_CACHE', 'default')
+
+# Watermarks prepared for the image sizes are kept in memory, up to this
+# many bytes per process
+PHOTOLOGUE_WATERMARK_CACHE_SIZE = getattr(settings, 'PHOTOLOGUE_WATERMARK_CACHE_SIZE', 64 * 2 ** 20)
+
+# Urls of sizes not created yet point to a view creating them on the first
+# request, instead of creating them while the page is rendered
+PHOTOLOGUE_LAZY_RENDITIONS = getattr(settings, 'PHOTOLOGUE_LAZY_RENDITIONS', False)
+# The view serves the sizes with a 'redirect' to their media url, or by
+# the web server with the 'X-Sendfile' or 'X-Accel-Redirect' header
+PHOTOLOGUE_RENDITION_SERVE = getattr(settings, 'PHOTOLOGUE_RENDITION_SERVE', 'redirect')
+
+# Processes creating the same size wait for each other at most this long
+# (in seconds), a size being created for longer is considered abandoned
+PHOTOLOGUE_RENDITION_LOCK_TIMEOUT = getattr(settings, 'PHOTOLOGUE_RENDITION_LOCK_TIMEOUT', 60)
+
+# Random samples have at most this many items, also when no count is given
+PHOTOLOGUE_SAMPLE_LIMIT = getattr(settings, 'PHOTOLOGUE_SAMPLE_LIMIT', 100)
+# Items of a random sample are read from this many random points at most,
+# the items following each other in the random key index come together
+PHOTOLOGUE_SAMPLE_PIVOTS = getattr(settings, 'PHOTOLOGUE_SAMPLE_PIVOTS', 10)
+
 # Photologue media path relative to media root
 PHOTOLOGUE_DIR = getattr(settings, 'PHOTOLOGUE_DIR', 'photologue')
 
@@ -51,6 +91,27 @@ DEFAULT_PHOTOLOGUE_GROUP_WRITE = getattr(settings, 'PHOTOLOGUE_GROUP_WRITE', Tru
 if DEFAULT_PHOTOLOGUE_GROUP_WRITE:
     old = os.umask(stat.S_IWOTH)
 
+# Time (in seconds) a video convert is reserved for the worker converting it
+PHOTOLOGUE_CONVERT_LEASE = getattr(settings, 'PHOTOLOGUE_CONVERT_LEASE', 10 * 60)
+# Interval (in seconds) in which running workers extend the lease
+PHOTOLOGUE_CONVERT_HEARTBEAT = getattr(settings, 'PHOTOLOGUE_CONVERT_HEARTBEAT', 60)
+# Failed or abandoned converts are retried after a delay (in seconds),
+# doubled after each attempt, until the maximum of attempts is reached
+PHOTOLOGUE_CONVERT_RETRY_DELAY = getattr(settings, 'PHOTOLOGUE_CONVERT_RETRY_DELAY', 5 * 60)
+PHOTOLOGUE_CONVERT_MAX_ATTEMPTS = getattr(settings, 'PHOTOLOGUE_CONVERT_MAX_ATTEMPTS', 5)
+# Minimal interval (in seconds) between progress updates of a running convert
+PHOTOLOGUE_CONVERT_PROGRESS_INTERVAL = getattr(settings, 'PHOTOLOGUE_CONVERT_PROGRESS_INTERVAL', 5)
+
+# Regeneration jobs are processed and checkpointed in batches of this many objects
+PHOTOLOGUE_REGENERATE_BATCH_SIZE = getattr(settings, 'PHOTOLOGUE_REGENERATE_BATCH_SIZE', 100)
+# Time (in seconds) a regeneration job is reserved for the worker, it is
+# extended after every batch, jobs of dead workers are resumed after it
+PHOTOLOGUE_REGENERATE_LEASE = getattr(settings, 'PHOTOLOGUE_REGENERATE_LEASE', 10 * 60)
+
+# Superseded size files are removed by plcleanup when they are older than
+# this (in seconds), so pages cached with the old URLs keep working meanwhile
+PHOTOLOGUE_CLEANUP_AGE = getattr(settings, 'PHOTOLOGUE_CLEANUP_AGE', 24 * 60 * 60)
+
 PHOTOLOGUE_VIDEO_EXTENTIONS = getattr(settings, 'PHOTOLOGUE_VIDEO_EXTENTIONS', ['mpg', 'mov'])
 
 # Quality options for JPEG images
@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
 from optparse import make_option
-from photologue.models import MediaSize, MediaModel
+from itertools import islice
+from photologue.models import MediaSize, media_models, media_queryset, prefetch_overrides
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
@@ -34,11 +36,27 @@ def create_cache(sizes, options):
 
     print 'Caching media, this may take a while...'
 
-    for cls in MediaModel.__subclasses__():
+    sizes = list(sizes)
+    count = 0
+    for cls in media_models():
         print cls.__name__
-        for mediasize in sizes:
-            print 'Caching %s size media' % mediasize.name
-            for obj in cls.objects.all():
+        objects = media_queryset(cls).iterator()
+        while True:
+            # Overrides for a whole batch are resolved with a single query
+            batch = list(islice(objects, GET_ITERATOR_CHUNK_SIZE))
+            if not batch:
+                break
+            prefetch_overrides(batch)
+            for obj in batch:
+                # Sizes whose files were removed are created again
+                obj.prune_cached_sizes()
                 if reset:
-                    obj.remove_size(mediasize)
-                obj.create_size(mediasize)
+                    for mediasize in sizes:
+                        obj.remove_size(mediasize)
+                if hasattr(obj, 'create_sizes'):
+                    obj.create_sizes(sizes)
+                else:
+                    for mediasize in sizes:
+                        obj.create_size(mediasize)
+                count += 1
+    print '%d items cached.' % count
@@ -0,0 +1,84 @@
+import os
+import time
+from itertools import islice
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+from django.utils.encoding import force_unicode
+from photologue.models import media_models, media_queryset, prefetch_overrides
+from photologue.default_settings import *
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', '-n', action='store_true', dest='dry_run', default=False,
+            help='Only list the files which would be removed'),
+        make_option('--age', '-a', type='int', dest='age', default=PHOTOLOGUE_CLEANUP_AGE,
+            help='Keep files modified in the last AGE seconds'),
+        )
+    help = ('Removes the files of superseded versions of sizes and of sizes which no longer exist.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return cleanup(options.get('dry_run'), options.get('age'))
+
+def current_renditions(prune=False):
+    """
+    Returns {cache directory: (file name prefixes, current file names)}
+    of all the media objects and the number of sizes listed as created
+    with missing files, which are forgotten if prune is set.
+    """
+    directories = {}
+    missing = 0
+    for cls in media_models():
+        objects = media_queryset(cls).iterator()
+        while True:
+            batch = list(islice(objects, GET_ITERATOR_CHUNK_SIZE))
+            if not batch:
+                break
+            prefetch_overrides(batch)
+            for obj in batch:
+                if not obj.file:
+                    continue
+                if prune:
+                    missing += len(obj.prune_cached_sizes())
+                path = obj.cache_path()
+                if not path:
+                    continue
+                prefixes, current = directories.setdefault(force_unicode(path), (set(), set()))
+                prefixes.add(os.path.splitext(obj.media_filename())[0] + '_')
+                current.update(force_unicode(name) for name in obj.rendition_filenames())
+    return directories, missing
+
+def cleanup(dry_run=False, age=PHOTOLOGUE_CLEANUP_AGE):
+    """
+    Removes the files in the cache directories which belong to a media object
+    but are not a current version of any of its sizes. The sizes whose
+    files are missing are forgotten, so they are created again.
+    """
+    limit = time.time() - age
+    count = 0
+    directories, missing = current_renditions(prune=not dry_run)
+    for path, (prefixes, current) in directories.items():
+        try:
+            names = os.listdir(path)
+        except OSError:
+            continue
+        for name in names:
+            # Hidden are lock files and files left by interrupted writes
+            if name in current or not any(name.lstrip('.').startswith(prefix) for prefix in prefixes):
+                continue
+            filename = os.path.join(path, name)
+            if not os.path.isfile(filename) or os.path.getmtime(filename) > limit:
+                continue
+            if dry_run:
+                print filename
+            else:
+                os.remove(filename)
+            count += 1
+    if dry_run:
+        print '%d superseded files found.' % count
+    else:
+        print '%d superseded files removed.' % count
+        print '%d missing sizes forgotten.' % missing
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from photologue.models import MediaModel, MediaOverride, count_overrides
+
+class Command(BaseCommand):
+    help = ('Counts the overrides of all media objects, objects added before the overrides were counted have none.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return recount_overrides()
+
+@transaction.commit_on_success
+def recount_overrides():
+    """
+    Stores the number of overrides on all media objects
+    """
+    targets = set(MediaOverride.objects.values_list('content_type', 'object_id'))
+    MediaModel.objects.exclude(override_count=0).update(override_count=0)
+    for content_type_id, object_id in targets:
+        count_overrides(content_type_id, object_id)
+    print 'Overrides of %d media objects counted.' % len(targets)
@@ -0,0 +1,29 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from photologue.models import ImageModel
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--all', '-a', action="store_true", dest='all', default=False,
+            help='Extract EXIF of all images, not only of those missing it'),
+    )
+    help = ('Stores the EXIF data of images which were added before they were extracted on save.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return update_exif(options.get('all'))
+
+def update_exif(all=False, batch=100):
+    """
+    Extracts and stores EXIF data of the images
+    """
+    images = ImageModel.objects.all()
+    if not all:
+        images = images.filter(exif_data__isnull=True)
+    ids = list(images.values_list('id', flat=True))
+    for start in xrange(0, len(ids), batch):
+        for image in ImageModel.objects.filter(id__in=ids[start:start+batch]):
+            image.update_exif()
+    print 'EXIF of %d images stored.' % len(ids)
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from photologue.models import MediaModel
+from photologue.utils import viewcount, is_shared_cache
+
+class Command(BaseCommand):
+    help = ('Writes the view counts buffered in the shared cache to the database.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return flush_views()
+
+def flush_views(batch=1000):
+    """
+    Flushes the view counts of all media
+    """
+    if not is_shared_cache(viewcount.view_cache()):
+        raise CommandError('PHOTOLOGUE_VIEW_COUNT_CACHE is not shared, '
+                           'each process writes the views it counted.')
+    ids = MediaModel.objects.order_by('id').values_list('id', flat=True)
+    total = 0
+    last = 0
+    while True:
+        # In chunks, the ids of all media are never held at once
+        chunk = list(ids.filter(id__gt=last)[:batch])
+        if not chunk:
+            break
+        total += viewcount.flush(chunk)
+        last = chunk[-1]
+    print '%d views written.' % total
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from photologue.models import GalleryItemBase
+
+class Command(BaseCommand):
+    help = ('Stores the type of the gallery items saved before the types were stored.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return store_item_types()
+
+@transaction.commit_on_success
+def store_item_types():
+    """
+    Stores the type of all gallery items missing it
+    """
+    count = 0
+    for cls in GalleryItemBase.__subclasses__():
+        item_type = cls.__name__.lower()
+        untyped = GalleryItemBase.objects.filter(item_type='').filter(**{'%s__isnull' % item_type: False})
+        count += untyped.update(item_type=item_type)
+    print '%d item types stored.' % count
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from photologue.models import Gallery, GalleryNeighbours
+
+class Command(BaseCommand):
+    help = ('Rebuilds the index of previous and next items of all galleries.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return rebuild_neighbours()
+
+def rebuild_neighbours():
+    """
+    Rebuilds the neighbour index of all galleries
+    """
+    count = 0
+    for gallery_id in Gallery.objects.values_list('pk', flat=True):
+        GalleryNeighbours.rebuild(gallery_id)
+        count += 1
+    print '%d galleries indexed.' % count
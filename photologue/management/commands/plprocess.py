@@ -1,10 +1,17 @@
 import os
+import errno
+import socket
+import threading
+from multiprocessing import Pool
 from optparse import make_option
 from datetime import datetime, timedelta
 from django.utils.timezone import now
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
-from photologue.models import VideoConvert, poster_unconverted, MediaSizeCache, Video
+from django.db import connection
+from django.db.models import Q, F
+from django.utils.encoding import force_unicode
+from photologue.models import VideoConvert, poster_unconverted, MediaSizeCache, MediaModel, Video
 from photologue.utils.video import *
 from photologue.default_settings import *
 
@@ -13,7 +20,11 @@ class Command(BaseCommand):
         make_option('--poster-only', '-p', action="store_true", dest='poster_only', default=False,
             help='Convert only posters, but check all videos.'),
         make_option('--unlock', '-u', action="store_true", dest='unlock', default=False,
-            help='Remove any "in progress" marks before converting'),
+            help='Requeue conversions of workers on this host which are no longer running, before their leases expire'),
+        make_option('--workers', '-w', type='int', dest='workers', default=1,
+            help='Number of videos converted in parallel'),
+        make_option('--batch', '-b', action="store_true", dest='batch', default=False,
+            help='Convert all sizes of a video at once, decoding it only once'),
         )
     help = 'Converts unprocessed photologue video files.'
 
@@ -22,11 +33,12 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         cleanup_converts()
+        reclaim_converts()
         if options.get('unlock'):
             unlock_converts()
         if options.get('poster_only'):
             return process_posters()
-        return process_files()
+        return process_files(options.get('workers'), options.get('batch'))
 
 def should_convert_poster(video):
     if poster_unconverted(video.poster):
@@ -54,88 +66,299 @@ def process_posters():
         except Exception, e:
             print e
 
-def process_files():
+def process_files(workers=1, batch=False):
     """
     Creates videosize files for the given video objects.
     """
 
-    convert_videos = VideoConvert.objects.filter(converted=False, inprogress=False)
-
-    if not convert_videos:
+    if not queued_converts().exists():
         print "No videos to convert"
+        return
+
+    if workers <= 1:
+        process_queue(batch=batch)
+        return
+
+    # Every worker process has to open its own database connection
+    connection.close()
+    pool = Pool(workers)
+    try:
+        pool.map(process_batch_queue if batch else process_queue, range(workers))
+    finally:
+        pool.close()
+        pool.join()
+
+def worker_name(index=0):
+    return '%s:%d:%d' % (socket.gethostname(), os.getpid(), index)
+
+def queued():
+    """
+    Returns the condition of a convert waiting for a worker.
+    """
+    return Q(Q(retry_after__isnull=True) | Q(retry_after__lte=now()),
+             converted=False, inprogress=False,
+             attempts__lt=PHOTOLOGUE_CONVERT_MAX_ATTEMPTS)
+
+def queued_converts():
+    """
+    Returns the converts waiting for a worker.
+    """
+    return VideoConvert.objects.filter(queued())
+
+def claim_converts(worker, convert_ids, limit=None):
+    """
+    Claims the converts for the worker, at most limit of them.
+
+    The claim is a conditional update on the whole queued condition, so only
+    one worker can win, even across hosts sharing the database, and converts
+    postponed or given up on since the ids were read are left alone.
+    """
+    converts = []
+    for convert_id in convert_ids:
+        claimed = VideoConvert.objects.filter(queued(), id=convert_id).update(
+                        inprogress=True, worker=worker, access_date=now(), heartbeat=now(),
+                        lease=now() + timedelta(seconds=PHOTOLOGUE_CONVERT_LEASE),
+                        progress=0, fps=None, eta=None)
+        if claimed:
+            converts.append(VideoConvert.objects.get(id=convert_id))
+            if len(converts) == limit:
+                break
+    return converts
+
+def claim_convert(worker):
+    """
+    Claims a queued convert for the worker.
+    """
+    converts = claim_converts(worker, queued_converts().values_list('id', flat=True), 1)
+    return converts[0] if converts else None
+
+def claim_video_converts(worker, video):
+    """
+    Claims the other queued converts of the video for the worker.
+    """
+    return claim_converts(worker, queued_converts().filter(video=video).values_list('id', flat=True))
 
-    for convert in convert_videos:
-        # Reload
+class Heartbeat(threading.Thread):
+    """
+    Extends the lease of claimed converts until stopped.
+    """
+    def __init__(self, converts, worker):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.convert_ids = [convert.id for convert in converts]
+        self.worker = worker
+        self.stopped = threading.Event()
+
+    def run(self):
         try:
-            convert = VideoConvert.objects.get(id=convert.id)
-            if convert.inprogress or convert.converted:
-                continue
-        except VideoConvert.DoesNotExist:
-            continue
-        # We are processing it - lock
-        # This is not 100% coherent lock, but it should do
-        convert.inprogress = True
-        convert.message = ''
-        convert.save()
+            while not self.stopped.wait(PHOTOLOGUE_CONVERT_HEARTBEAT):
+                VideoConvert.objects.filter(id__in=self.convert_ids, worker=self.worker, inprogress=True).update(
+                        heartbeat=now(), lease=now() + timedelta(seconds=PHOTOLOGUE_CONVERT_LEASE))
+        finally:
+            # Database connections are per thread
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class Progress(object):
+    """
+    Stores the progress reported by ffmpeg to the converts,
+    at most once per PHOTOLOGUE_CONVERT_PROGRESS_INTERVAL.
+    """
+    def __init__(self, converts):
+        self.convert_ids = [convert.id for convert in converts]
+        self.worker = converts[0].worker
+        self.last = None
+
+    def __call__(self, percent, fps=None, eta=None):
+        if self.last is not None and percent < 100 and \
+                (datetime.now() - self.last).total_seconds() < PHOTOLOGUE_CONVERT_PROGRESS_INTERVAL:
+            return
+        self.last = datetime.now()
+        VideoConvert.objects.filter(id__in=self.convert_ids, worker=self.worker, inprogress=True).update(
+                progress=percent, fps=fps,
+                eta=now() + timedelta(seconds=eta) if eta is not None else None)
 
-        filepath = convert.video.file.path
-        # Calculate size to convert
+def process_queue(index=0, batch=False):
+    """
+    Converts queued videos until there is nothing left to claim.
+    """
+    worker = worker_name(index)
+    while True:
+        # Sizes changed by the web server processes meanwhile
+        MediaSizeCache.check_version()
+        reclaim_converts()
+        convert = claim_convert(worker)
+        if convert is None:
+            break
+        converts = [convert]
+        if batch:
+            converts += claim_video_converts(worker, convert.video)
+        heartbeat = Heartbeat(converts, worker)
+        heartbeat.start()
         try:
-            out_w, out_h = video_calculate_size(convert.video, convert.videosize)
-        except Exception, e:
-            print "Failed to get sizes: ", os.path.split(filepath)[1]
-            convert.message = e
-            convert.inprogress = False
-            convert.save()
-            continue
+            if batch:
+                process_batch(converts)
+            else:
+                process_convert(convert)
+        finally:
+            heartbeat.stop()
 
-        video_data = {
-                      'orig_w': convert.video.width,
-                      'orig_h': convert.video.height,
-                      'duration': convert.video.duration,
-                      'size': (out_w, out_h),
-                      'videobitrate': convert.videosize.videobitrate,
-                      'audiobitrate': convert.videosize.audiobitrate,
-                      'twopass': convert.videosize.twopass,
-                      'deinterlace': 'yadif' if convert.videosize.deinterlace else '',
-                      }
-        if convert.videosize.letterbox:
-            video_data['letterboxing'] = 'pad="%d:%d:(ow-iw)/2:(oh-ih)/2:black"' % (out_w, out_h)
-
-        # Create poster
+def process_batch_queue(index=0):
+    return process_queue(index, batch=True)
+
+def retry_delay(attempts):
+    return timedelta(seconds=PHOTOLOGUE_CONVERT_RETRY_DELAY * 2 ** (attempts - 1))
+
+def owned_convert(convert):
+    """
+    Returns the convert row if it is still claimed by the worker which
+    holds the convert. After the lease expired, it could have been requeued
+    and claimed by another worker, whose claim must not be overwritten.
+    """
+    return VideoConvert.objects.filter(id=convert.id, worker=convert.worker, inprogress=True)
+
+def release_convert(convert, message):
+    print message
+    released = owned_convert(convert).update(
+                    inprogress=False, lease=None, attempts=F('attempts') + 1,
+                    retry_after=now() + retry_delay(convert.attempts + 1),
+                    progress=0, fps=None, eta=None, message=force_unicode(message),
+                    access_date=now())
+    if not released:
+        print 'Lease of %s was lost, the failure is not recorded' % convert
+
+def finish_convert(convert, start):
+    finished = owned_convert(convert).update(
+                    time=(datetime.now() - start).total_seconds(),
+                    inprogress=False, lease=None, converted=True,
+                    progress=100, eta=None, message=convert.message,
+                    access_date=now())
+    if not finished:
+        print 'Lease of %s was lost, the result is dropped' % convert
+        return
+    # Other converts of the video may have finished since it was loaded
+    video = convert.video
+    video.cached_sizes = MediaModel.objects.filter(id=video.id).values_list('cached_sizes', flat=True)[0]
+    video._add_cached_sizes([convert.videosize.name])
+
+def convert_data(convert):
+    """
+    Returns the conversion parameters of the convert.
+    """
+    # Calculate size to convert
+    out_w, out_h = video_calculate_size(convert.video, convert.videosize)
+    video_data = {
+                  'orig_w': convert.video.width,
+                  'orig_h': convert.video.height,
+                  'duration': convert.video.duration,
+                  'size': (out_w, out_h),
+                  'videobitrate': convert.videosize.videobitrate,
+                  'audiobitrate': convert.videosize.audiobitrate,
+                  'twopass': convert.videosize.twopass,
+                  'deinterlace': 'yadif' if convert.videosize.deinterlace else '',
+                  }
+    if convert.videosize.letterbox:
+        video_data['letterboxing'] = 'pad="%d:%d:(ow-iw)/2:(oh-ih)/2:black"' % (out_w, out_h)
+    return video_data
+
+def create_poster(convert, video_data):
+    if convert.video.poster and should_convert_poster(convert.video):
+        return video_create_poster(convert.video.file.path, convert.video.poster, video_data)
+    return ''
+
+def process_convert(convert):
+    convert.message = ''
+
+    filepath = convert.video.file.path
+    try:
+        video_data = convert_data(convert)
+    except Exception, e:
+        print "Failed to get sizes: ", os.path.split(filepath)[1]
+        release_convert(convert, e)
+        return
+    video_data['progress'] = Progress([convert])
+
+    # Create poster
+    try:
+        convert.message = create_poster(convert, video_data)
+    except Exception, e:
+        release_convert(convert, e)
+        return
+
+    func = 'convertvideo_%s' % convert.videosize.videotype
+    start = datetime.now()
+    try:
+        out = convert.video._get_SIZE_filename(convert.videosize.name, invalid_ok=True)
         try:
-            if convert.video.poster and should_convert_poster(convert.video):
-                convert.message = video_create_poster(filepath, convert.video.poster, video_data)
+            os.remove(out)
+        except:
+            pass
+        convert.message += globals()[func](filepath, out, video_data)
+    except Exception, e:
+        try:
+            os.remove(out)
+        except:
+            pass
+        release_convert(convert, e)
+        return
+    finish_convert(convert, start)
+
+def process_batch(converts):
+    """
+    Converts all the converts of one video with a single ffmpeg run.
+    Types not supported by convertvideo_batch are converted one by one.
+    """
+    filepath = converts[0].video.file.path
+    batch = []
+    for convert in converts:
+        convert.message = ''
+        if convert.videosize.videotype not in BATCH_VIDEO_TYPES:
+            process_convert(convert)
+            continue
+        try:
+            video_data = convert_data(convert)
         except Exception, e:
-            print e
-            convert.inprogress = False
-            convert.message = e
-            convert.save()
+            print "Failed to get sizes: ", os.path.split(filepath)[1]
+            release_convert(convert, e)
             continue
+        out = convert.video._get_SIZE_filename(convert.videosize.name, invalid_ok=True)
+        batch.append((convert, (convert.videosize.videotype, out, video_data)))
+    if not batch:
+        return
 
-        func = 'convertvideo_%s' % convert.videosize.videotype
-        start = datetime.now()
+    # Create poster
+    try:
+        message = create_poster(batch[0][0], batch[0][1][2])
+    except Exception, e:
+        for convert, output in batch:
+            release_convert(convert, e)
+        return
+
+    for convert, (videotype, out, video_data) in batch:
         try:
-            out = convert.video._get_SIZE_filename(convert.videosize.name, invalid_ok=True)
-            try:
-                os.remove(out)
-            except:
-                pass
-            convert.message += globals()[func](filepath, out, video_data)
-        except Exception, e:
+            os.remove(out)
+        except:
+            pass
+    start = datetime.now()
+    try:
+        output, errors = convertvideo_batch(filepath, [output for convert, output in batch],
+                                            Progress([convert for convert, output in batch]))
+    except Exception, e:
+        errors = [e] * len(batch)
+        output = ''
+    for (convert, (videotype, out, video_data)), error in zip(batch, errors):
+        if error is not None:
             try:
                 os.remove(out)
             except:
                 pass
-            print e
-            convert.inprogress = False
-            convert.message = e
-            convert.save()
+            release_convert(convert, error)
             continue
-        convert.time = (datetime.now() - start).total_seconds()
-        convert.inprogress = False
-        convert.converted = True
-        convert.save()
+        convert.message = message + output
+        finish_convert(convert, start)
 
 def cleanup_converts():
     for convert in VideoConvert.objects.all():
@@ -145,8 +368,45 @@ def cleanup_converts():
         if (now() - convert.access_date) > timedelta(7):
             convert.delete()
 
+def reclaim_converts():
+    """
+    Requeues converts of workers which stopped extending their lease.
+    """
+    # Converts claimed before leases existed have none
+    expired = VideoConvert.objects.filter(Q(lease__isnull=True) | Q(lease__lt=now()),
+                                          converted=False, inprogress=True)
+    for convert in expired:
+        attempts = convert.attempts + 1
+        # Do not take it, if the lease was extended meanwhile
+        VideoConvert.objects.filter(id=convert.id, inprogress=True, lease=convert.lease).update(
+                inprogress=False, lease=None, attempts=attempts,
+                retry_after=now() + retry_delay(attempts),
+                message='Lease of worker %s expired.' % convert.worker)
+
+def worker_running(worker):
+    """
+    Returns False if the worker ran on this host and its process is gone.
+    """
+    try:
+        host, pid, index = worker.rsplit(':', 2)
+        pid = int(pid)
+    except ValueError:
+        return True
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
 def unlock_converts():
-    for convert in VideoConvert.objects.all():
-        if convert.inprogress:
-            convert.inprogress = False
-            convert.save()
+    """
+    Requeues converts of this host's workers which died, without waiting
+    for their leases to expire. Workers of other hosts are left to
+    reclaim_converts.
+    """
+    for convert in VideoConvert.objects.filter(inprogress=True, worker__startswith=socket.gethostname() + ':'):
+        if not worker_running(convert.worker):
+            VideoConvert.objects.filter(id=convert.id, inprogress=True, worker=convert.worker).update(
+                    inprogress=False, lease=None)
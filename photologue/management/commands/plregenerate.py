@@ -0,0 +1,108 @@
+import os
+import socket
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db.models import Q, F
+from django.utils.timezone import now
+from photologue.models import RegenerationJob, MediaSizeCache, prefetch_overrides, WATERMARK_CACHE
+from photologue.default_settings import *
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--list', '-l', action='store_true', dest='list', default=False,
+            help='Only list the unfinished jobs and their progress'),
+        )
+    help = ('Renders the sizes again after a size or an effect was changed.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        if options.get('list'):
+            return list_jobs()
+        return process_jobs()
+
+def worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def lease():
+    return now() + timedelta(seconds=PHOTOLOGUE_REGENERATE_LEASE)
+
+def claimable_jobs():
+    """
+    Returns the unfinished jobs which are not reserved by a running worker.
+    """
+    return RegenerationJob.objects.filter(finished=None).filter(Q(lease=None) | Q(lease__lt=now()))
+
+def claim_job(worker):
+    """
+    Claims a queued job, or a job abandoned by its worker, which is then
+    resumed after its checkpoint.
+    """
+    for job_id in claimable_jobs().values_list('id', flat=True):
+        claimed = claimable_jobs().filter(id=job_id).update(worker=worker, lease=lease())
+        if claimed:
+            job = RegenerationJob.objects.get(id=job_id)
+            if job.started is None:
+                job.started = now()
+                job.total = job.get_queryset().count()
+                RegenerationJob.objects.filter(id=job_id).update(started=job.started, total=job.total)
+            return job
+    return None
+
+def run_job(job, worker):
+    """
+    Processes the job in batches, the checkpoint is stored after each batch.
+    Returns False if the job was taken over by another worker meanwhile.
+    """
+    while True:
+        # Sizes changed meanwhile are rendered in their latest version
+        MediaSizeCache.check_version()
+        sizes = job.get_sizes()
+        queryset = job.get_queryset()
+        if job.checkpoint is not None:
+            queryset = queryset.filter(pk__gt=job.checkpoint)
+        batch = list(queryset[:PHOTOLOGUE_REGENERATE_BATCH_SIZE])
+        if not batch or not (sizes or job.size_name):
+            break
+        prefetch_overrides(batch)
+        errors = 0
+        for obj in batch:
+            try:
+                job.process(obj, sizes)
+            except Exception, e:
+                print 'Failed to render %s: %s' % (obj, e)
+                errors += 1
+        job.checkpoint = batch[-1].pk
+        job.done += len(batch)
+        job.errors += errors
+        updated = RegenerationJob.objects.filter(id=job.id, worker=worker).update(
+                        checkpoint=job.checkpoint, done=F('done') + len(batch),
+                        errors=F('errors') + errors, lease=lease())
+        if not updated:
+            print '%s: taken over by another worker' % job
+            return False
+        print '%s: %d/%d (%d%%)' % (job, job.done, job.total, job.progress())
+    RegenerationJob.objects.filter(id=job.id, worker=worker).update(finished=now(), lease=None)
+    return True
+
+def process_jobs():
+    worker = worker_name()
+    count = 0
+    while True:
+        job = claim_job(worker)
+        if job is None:
+            break
+        if run_job(job, worker):
+            count += 1
+    print '%d jobs finished.' % count
+    if WATERMARK_CACHE.hits or WATERMARK_CACHE.misses:
+        print 'Watermark cache: %(hits)d hits, %(misses)d misses, %(items)d layers, %(cost)d bytes.' % WATERMARK_CACHE.stats()
+
+def list_jobs():
+    for job in RegenerationJob.objects.filter(finished=None):
+        if job.started is None:
+            print '%s: queued' % job
+        else:
+            print '%s: %d/%d (%d%%), %s' % (job, job.done, job.total, job.progress(), job.worker)
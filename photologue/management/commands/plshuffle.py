@@ -0,0 +1,24 @@
+import random
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from photologue.models import GalleryItemBase
+
+class Command(BaseCommand):
+    help = ('Assigns new random keys to all gallery items, so random samples change their neighbours.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return shuffle_items()
+
+@transaction.commit_on_success
+def shuffle_items():
+    """
+    Assigns new random keys to all gallery items
+    """
+    count = 0
+    for pk in GalleryItemBase.objects.values_list('pk', flat=True):
+        GalleryItemBase.objects.filter(pk=pk).update(random_key=random.random())
+        count += 1
+    print '%d items shuffled.' % count
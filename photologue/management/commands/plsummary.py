@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from photologue.models import Gallery, GallerySummary
+
+class Command(BaseCommand):
+    help = ('Rebuilds the item counts, covers and latest items of all galleries.')
+
+    requires_model_validation = True
+    can_import_settings = True
+
+    def handle(self, *args, **options):
+        return rebuild_summaries()
+
+def rebuild_summaries():
+    """
+    Rebuilds the summaries of all galleries
+    """
+    count = 0
+    for gallery in Gallery.objects.all():
+        GallerySummary.rebuild(gallery)
+        count += 1
+    print '%d galleries summarized.' % count
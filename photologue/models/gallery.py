@@ -2,8 +2,11 @@ from os import path
 from datetime import datetime
 import zipfile
 import unicodedata
+import random
+from itertools import islice
 
 from django.db import models
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now, make_aware, get_current_timezone
@@ -17,6 +20,22 @@ from taggit.utils import parse_tags
 from media import MediaModel
 
 
+class GalleryQuerySet(models.query.QuerySet):
+    def iterator(self):
+        iter = super(GalleryQuerySet, self).iterator()
+        # Covers and latest items of a chunk of galleries are downcast together
+        while True:
+            chunk = list(islice(iter, GET_ITERATOR_CHUNK_SIZE))
+            if not chunk:
+                break
+            prefetch_summary_items(chunk)
+            for gallery in chunk:
+                yield gallery
+
+class GalleryManager(models.Manager):
+    def get_query_set(self):
+        return GalleryQuerySet(self.model).select_related('summary__cover', 'summary__latest')
+
 class Gallery(models.Model):
     date_added = models.DateTimeField(_('date published'), default=now)
     title = models.CharField(_('title'), max_length=100, unique=True)
@@ -28,6 +47,7 @@ class Gallery(models.Model):
     items = models.ManyToManyField('GalleryItemBase', related_name='galleries', verbose_name=_('items'),
                                     null=True, blank=True)#, through="GalleryMedia")
     tags = TaggableManager(blank=True)
+    objects = GalleryManager()
 
     class Meta:
         app_label=THIS_APP
@@ -51,17 +71,29 @@ class Gallery(models.Model):
     def sample(self, count=0, public=True):
         return self.items.sample(count, public)
 
-    def cover(self):
+    def get_summary(self):
         try:
-            return self.items.filter(is_thumbnail=True).all()[0]
-        except:
-            return self.items.all()[0]
+            summary = self.summary
+        except GallerySummary.DoesNotExist:
+            summary = None
+        # select_related gives None for missing summaries
+        if summary is None:
+            summary = self.summary = GallerySummary.rebuild(self)
+        return summary
+
+    def cover(self):
+        return self.get_summary().cover_item()
 
     def item_count(self, public=True):
-        return self.items.item_count(public)
+        summary = self.get_summary()
+        if public:
+            return summary.public_count
+        return summary.item_count
     item_count.short_description = _('count')
     
     def latest_item(self, public=True):
+        if public:
+            return self.get_summary().latest_item() or False
         try:
             return self.latest(limit=1, public=public)[0]
         except IndexError:
@@ -76,6 +108,229 @@ class Gallery(models.Model):
         except:
             return None
 
+class GallerySummary(models.Model):
+    """
+    Counts, cover and latest public item of a gallery, kept up to date
+    as items are added, removed or changed.
+    """
+    gallery = models.OneToOneField(Gallery, primary_key=True, related_name='summary')
+    item_count = models.PositiveIntegerField(_('item count'), default=0)
+    public_count = models.PositiveIntegerField(_('public item count'), default=0)
+    cover = models.ForeignKey('GalleryItemBase', null=True, blank=True, related_name='+',
+                              on_delete=models.SET_NULL, verbose_name=_('cover'))
+    latest = models.ForeignKey('GalleryItemBase', null=True, blank=True, related_name='+',
+                               on_delete=models.SET_NULL, verbose_name=_('latest public item'))
+    latest_date = models.DateTimeField(_('latest date added'), null=True, blank=True)
+
+    class Meta:
+        app_label=THIS_APP
+        verbose_name = _('gallery summary')
+        verbose_name_plural = _('gallery summaries')
+
+    def __unicode__(self):
+        return unicode(self.gallery_id)
+
+    @classmethod
+    def rebuild(cls, gallery):
+        """
+        Computes the summary of the gallery from scratch.
+        """
+        summary = cls(gallery=gallery)
+        items = GalleryItemBase.objects.filter(galleries=gallery)
+        summary.item_count = items.count()
+        summary.public_count = items.filter(is_public=True).count()
+        summary.cover_id = summary.find_cover()
+        summary.latest_id, summary.latest_date = summary.find_latest()
+        summary.save()
+        return summary
+
+    def items(self):
+        return GalleryItemBase.objects.filter(galleries=self.gallery_id)
+
+    def cover_item(self):
+        if self.cover_id is None:
+            return None
+        if not hasattr(self, '_cover_item'):
+            self._cover_item = downcast_items([self.cover])[0]
+        return self._cover_item
+
+    def latest_item(self):
+        if self.latest_id is None:
+            return None
+        if not hasattr(self, '_latest_item'):
+            self._latest_item = downcast_items([self.latest])[0]
+        return self._latest_item
+
+    def find_cover(self):
+        for pk in self.items().filter(is_thumbnail=True).values_list('pk', flat=True)[:1]:
+            return pk
+        for pk in self.items().values_list('pk', flat=True)[:1]:
+            return pk
+        return None
+
+    def find_latest(self):
+        for latest in self.items().filter(is_public=True).order_by('-date_added').values_list('pk', 'date_added')[:1]:
+            return latest
+        return (None, None)
+
+    def items_added(self, items):
+        """
+        Updates the summary with the newly added items (value dicts
+        of pk, is_public, is_thumbnail and date_added).
+        """
+        public = [item for item in items if item['is_public']]
+        GallerySummary.objects.filter(pk=self.pk).update(
+                item_count=models.F('item_count') + len(items),
+                public_count=models.F('public_count') + len(public))
+        changed = {}
+        # Without a thumbnail the newest item is the cover
+        cover_id = self.find_cover()
+        if cover_id != self.cover_id:
+            changed['cover'] = self.cover_id = cover_id
+        for item in public:
+            if self.latest_date is None or item['date_added'] > self.latest_date:
+                self.latest_id, self.latest_date = item['pk'], item['date_added']
+                changed['latest'], changed['latest_date'] = self.latest_id, self.latest_date
+        if changed:
+            GallerySummary.objects.filter(pk=self.pk).update(**changed)
+
+    def items_removed(self, items):
+        """
+        Updates the summary with the removed items (value dicts as above).
+        """
+        public = [item for item in items if item['is_public']]
+        # Items removed before the summary was built are not counted in it
+        if not GallerySummary.objects.filter(pk=self.pk, item_count__gte=len(items),
+                                             public_count__gte=len(public)).update(
+                item_count=models.F('item_count') - len(items),
+                public_count=models.F('public_count') - len(public)):
+            GallerySummary.rebuild(self.gallery)
+            return
+        pks = set(item['pk'] for item in items)
+        changed = {}
+        if self.cover_id in pks:
+            changed['cover'] = self.cover_id = self.find_cover()
+        if self.latest_id in pks:
+            self.latest_id, self.latest_date = self.find_latest()
+            changed['latest'], changed['latest_date'] = self.latest_id, self.latest_date
+        if changed:
+            GallerySummary.objects.filter(pk=self.pk).update(**changed)
+
+    def item_changed(self, old, item):
+        """
+        Updates the summary with an item whose is_public, is_thumbnail or
+        date_added changed (value dicts of the old and the new state).
+        """
+        if item['is_public'] and not old['is_public']:
+            GallerySummary.objects.filter(pk=self.pk).update(public_count=models.F('public_count') + 1)
+        elif old['is_public'] and not item['is_public']:
+            if not GallerySummary.objects.filter(pk=self.pk, public_count__gte=1).update(
+                    public_count=models.F('public_count') - 1):
+                GallerySummary.rebuild(self.gallery)
+                return
+        changed = {}
+        if (old['is_thumbnail'], old['date_added']) != (item['is_thumbnail'], item['date_added']):
+            cover_id = self.find_cover()
+            if cover_id != self.cover_id:
+                changed['cover'] = self.cover_id = cover_id
+        if self.latest_id == item['pk'] and (not item['is_public'] or item['date_added'] < self.latest_date):
+            self.latest_id, self.latest_date = self.find_latest()
+            changed['latest'], changed['latest_date'] = self.latest_id, self.latest_date
+        elif item['is_public'] and (self.latest_date is None or item['date_added'] > self.latest_date):
+            self.latest_id, self.latest_date = item['pk'], item['date_added']
+            changed['latest'], changed['latest_date'] = self.latest_id, self.latest_date
+        if changed:
+            GallerySummary.objects.filter(pk=self.pk).update(**changed)
+
+class GalleryNeighbours(models.Model):
+    """
+    Previous and next public item of an item in a gallery, by date added.
+
+    Every item of the gallery has an entry, the links skip private items.
+    """
+    gallery = models.ForeignKey(Gallery, related_name='+')
+    item = models.ForeignKey('GalleryItemBase', related_name='neighbours')
+    date_added = models.DateTimeField(_('date added'), db_index=True)
+    is_public = models.BooleanField(_('is public'))
+    # Links to deleted items are moved to their neighbours on pre_delete
+    previous = models.ForeignKey('GalleryItemBase', null=True, blank=True, related_name='+',
+                                 on_delete=models.DO_NOTHING)
+    next = models.ForeignKey('GalleryItemBase', null=True, blank=True, related_name='+',
+                             on_delete=models.DO_NOTHING)
+
+    class Meta:
+        app_label=THIS_APP
+        unique_together = ('gallery', 'item')
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.gallery_id, self.item_id)
+
+    @classmethod
+    def rebuild(cls, gallery_id):
+        """
+        Builds the entries of the gallery from scratch.
+        """
+        cls.objects.filter(gallery=gallery_id).delete()
+        entries = [cls(gallery_id=gallery_id, item_id=pk, date_added=date_added, is_public=is_public)
+                   for pk, date_added, is_public in GalleryItemBase.objects.filter(galleries=gallery_id)
+                        .order_by('date_added', 'pk').values_list('pk', 'date_added', 'is_public')]
+        previous = None
+        for entry in entries:
+            entry.previous_id = previous
+            if entry.is_public:
+                previous = entry.item_id
+        next = None
+        for entry in reversed(entries):
+            entry.next_id = next
+            if entry.is_public:
+                next = entry.item_id
+        cls.objects.bulk_create(entries)
+
+    @staticmethod
+    def before(date_added, pk):
+        return models.Q(date_added__lt=date_added) | models.Q(date_added=date_added, item__lt=pk)
+
+    @staticmethod
+    def after(date_added, pk):
+        return models.Q(date_added__gt=date_added) | models.Q(date_added=date_added, item__gt=pk)
+
+    @classmethod
+    def insert(cls, gallery_id, item):
+        """
+        Adds the item (value dict of pk, is_public and date_added)
+        to the gallery and relinks its neighbours.
+        """
+        entries = cls.objects.filter(gallery=gallery_id)
+        key = (item['date_added'], item['pk'])
+        try:
+            previous = entries.filter(cls.before(*key), is_public=True) \
+                        .order_by('-date_added', '-item').values_list('item', flat=True)[0]
+        except IndexError:
+            previous = None
+        try:
+            next = entries.filter(cls.after(*key), is_public=True) \
+                        .order_by('date_added', 'item').values_list('item', flat=True)[0]
+        except IndexError:
+            next = None
+        if item['is_public']:
+            # Entries between the public neighbours now link to the item
+            entries.filter(cls.before(*key), next=next).update(next=item['pk'])
+            entries.filter(cls.after(*key), previous=previous).update(previous=item['pk'])
+        cls.objects.create(gallery_id=gallery_id, item_id=item['pk'], date_added=item['date_added'],
+                           is_public=item['is_public'], previous_id=previous, next_id=next)
+
+    @classmethod
+    def remove(cls, gallery_id, pk):
+        """
+        Removes the item from the gallery and relinks its neighbours.
+        """
+        for entry in cls.objects.filter(gallery=gallery_id, item=pk):
+            entry.delete()
+            if entry.is_public:
+                entries = cls.objects.filter(gallery=gallery_id)
+                entries.filter(next=pk).update(next=entry.next_id)
+                entries.filter(previous=pk).update(previous=entry.previous_id)
+
 #class GalleryMedia(models.Model):
 #    gallery = models.ForeignKey(Gallery)
 #    media = models.ForeignKey(MediaModel)
@@ -164,18 +419,98 @@ class GalleryUpload(models.Model):
                     count = 0
             zip.close()
 
+def downcast_items(items):
+    """
+    Returns the subclass instances (Photo, Video, ...) of the items,
+    in the same order. Each subclass is fetched with a single query.
+    """
+    subclasses = dict((cls.__name__.lower(), cls) for cls in GalleryItemBase.__subclasses__())
+    by_type = {}
+    untyped = []
+    for item in items:
+        if not item.item_type:
+            untyped.append(item)
+        elif item.item_type in subclasses and not isinstance(item, subclasses[item.item_type]):
+            by_type.setdefault(item.item_type, []).append(item.pk)
+    fetched = {}
+    for item_type, pks in by_type.items():
+        for obj in subclasses[item_type]._base_manager.filter(pk__in=pks):
+            fetched[(item_type, obj.pk)] = obj
+    if untyped:
+        # Items saved before the type was stored, each subclass is probed
+        # once for all of them and the found types are stored
+        pks = [item.pk for item in untyped]
+        for item_type, cls in subclasses.items():
+            found = list(cls._base_manager.filter(pk__in=pks))
+            for obj in found:
+                fetched[(item_type, obj.pk)] = obj
+            if found:
+                GalleryItemBase.objects.filter(pk__in=[obj.pk for obj in found]).update(item_type=item_type)
+        types = dict((pk, item_type) for item_type, pk in fetched)
+        for item in untyped:
+            item.item_type = types.get(item.pk, '')
+    return [fetched.get((item.item_type, item.pk), item) for item in items]
+
+def prefetch_summary_items(galleries):
+    """
+    Downcasts the covers and latest items of the galleries at once,
+    with a single query per item type.
+    """
+    summaries = []
+    for gallery in galleries:
+        # Only summaries loaded by select_related, missing ones are None
+        summary = getattr(gallery, Gallery.summary.cache_name, None)
+        if summary is not None:
+            summaries.append(summary)
+    items = [item for summary in summaries for item in (summary.cover, summary.latest) if item is not None]
+    items = dict((item.pk, item) for item in downcast_items(items))
+    for summary in summaries:
+        if summary.cover_id is not None:
+            summary._cover_item = items[summary.cover_id]
+        if summary.latest_id is not None:
+            summary._latest_item = items[summary.latest_id]
+
+def random_run(queryset, pivot, count):
+    """
+    Returns count items of the queryset following the pivot in the random
+    key index, wrapping around at its end.
+    """
+    items = list(queryset.filter(random_key__gte=pivot).order_by('random_key')[:count])
+    if len(items) < count:
+        items += list(queryset.filter(random_key__lt=pivot).order_by('random_key')[:count - len(items)])
+    return items
+
+def random_sample(queryset, count=0):
+    """
+    Returns a list of count items of the queryset in random order, at most
+    PHOTOLOGUE_SAMPLE_LIMIT of them. They are read in runs from random points
+    of the random key index, instead of sorting the whole table.
+    """
+    if not count or count > PHOTOLOGUE_SAMPLE_LIMIT:
+        count = PHOTOLOGUE_SAMPLE_LIMIT
+    pivots = min(count, PHOTOLOGUE_SAMPLE_PIVOTS)
+    run = (count + pivots - 1) // pivots
+    items = {}
+    for i in range(pivots):
+        for item in random_run(queryset, random.random(), run):
+            items.setdefault(item.pk, item)
+    if len(items) < count:
+        # The runs overlapped, or there are fewer items
+        for item in random_run(queryset.exclude(pk__in=items.keys()), random.random(), count - len(items)):
+            items[item.pk] = item
+    items = items.values()
+    random.shuffle(items)
+    return items[:count]
+
 class GalleryItemQuerySet(models.query.QuerySet):
     def iterator(self):
         iter = super(GalleryItemQuerySet, self).iterator()
-        for obj in iter:
-            subclass = False
-            for cls in GalleryItemBase.__subclasses__():
-                cls = cls.__name__.lower()
-                if hasattr(obj, cls):
-                    subclass = True
-                    yield getattr(obj, cls)
-                    break
-            if not subclass:
+        # Downcast the rows chunk by chunk, one query per type and chunk
+        while True:
+            chunk = list(islice(iter, GET_ITERATOR_CHUNK_SIZE))
+            if not chunk:
+                break
+            for obj in downcast_items(chunk):
                 yield obj
 
 class GalleryItemManager(models.Manager):
@@ -202,12 +537,10 @@ class GalleryItemManager(models.Manager):
 
     def sample(self, count=0, public=True):
         if public:
-            item_set = self.public().order_by('?')
+            item_set = self.public()
         else:
-            item_set = self.order_by('?')
-        if count == 0:
-            return item_set
-        return item_set[:count]
+            item_set = self.all()
+        return random_sample(item_set, count)
 
 class GalleryItemBase(models.Model):
     # Fixing mult-table inheritance field shadowing
@@ -220,6 +553,10 @@ class GalleryItemBase(models.Model):
     date_added = models.DateTimeField(_('date added'), default=now, editable=False)
     is_public = models.BooleanField(_('is public'), default=True, help_text=_('Public photographs will be displayed in the default views.'))
     is_thumbnail = models.BooleanField(_('Is the main thumbnail for the gallery'), default=False, help_text=_('This image will show up as the thumbnail for the gallery.'))
+    item_type = models.CharField(_('type'), max_length=32, blank=True, default='', editable=False, db_index=True,
+                                 help_text=_('Name of the subclass (photo, video) the item is.'))
+    random_key = models.FloatField(_('random key'), default=random.random, editable=False, db_index=True,
+                                   help_text=_('Position of the item in random samples.'))
 
     tags = TaggableManager(blank=True)
     objects = GalleryItemManager()
@@ -238,12 +575,21 @@ class GalleryItemBase(models.Model):
     def save(self, *args, **kwargs):
         if self.title_slug is None:
             self.title_slug = slugify(self.title)
+        for cls in type(self).__mro__:
+            if GalleryItemBase in cls.__bases__:
+                self.item_type = cls.__name__.lower()
+                break
         super(GalleryItemBase, self).save(*args, **kwargs)
 
     def type(self):
+        if self.item_type:
+            return self.item_type
+        # Items saved before the type was stored, look it up once
         for cls in GalleryItemBase.__subclasses__():
             cls = cls.__name__.lower()
             if hasattr(self, cls):
+                self.item_type = cls
+                GalleryItemBase.objects.filter(pk=self.pk).update(item_type=cls)
                 return cls
         return type(self).__name__.lower()
 
@@ -254,17 +600,155 @@ class GalleryItemBase(models.Model):
         """Return the public galleries to which this item belongs."""
         return self.galleries.filter(is_public=True)
 
+    def gallery_neighbours(self):
+        """
+        Returns {gallery id: (previous, next)} for all galleries of the item,
+        fetched at once on first use.
+        """
+        if not hasattr(self, '_gallery_neighbours'):
+            entries = list(GalleryNeighbours.objects.filter(item=self.gallery_id).select_related('previous', 'next'))
+            items = downcast_items([item for entry in entries for item in (entry.previous, entry.next) if item])
+            items = dict((item.pk, item) for item in items)
+            self._gallery_neighbours = dict((entry.gallery_id, (items.get(entry.previous_id), items.get(entry.next_id)))
+                                            for entry in entries)
+        return self._gallery_neighbours
+
     def get_previous_in_gallery(self, gallery):
+        if gallery.pk in self.gallery_neighbours():
+            return self.gallery_neighbours()[gallery.pk][0]
+        # Galleries not indexed yet
         try:
-
             return self.galleryitembase_ptr.get_previous_by_date_added(
                         galleries__exact=gallery, is_public=True)
         except GalleryItemBase.DoesNotExist:
             return None
 
     def get_next_in_gallery(self, gallery):
+        if gallery.pk in self.gallery_neighbours():
+            return self.gallery_neighbours()[gallery.pk][1]
         try:
             return self.galleryitembase_ptr.get_next_by_date_added(
                         galleries__exact=gallery, is_public=True)
         except GalleryItemBase.DoesNotExist:
             return None
+
+# Maintenance of the gallery summaries
+
+SUMMARY_FIELDS = ('pk', 'is_public', 'is_thumbnail', 'date_added')
+
+def neighbours_indexed(gallery_id):
+    """
+    Galleries without entries have not been indexed yet (or are empty),
+    there is nothing to maintain.
+    """
+    return GalleryNeighbours.objects.filter(gallery=gallery_id).exists()
+
+def gallery_items_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action in ('pre_clear', 'pre_remove'):
+        # Remember what is going to be removed, the rows are gone afterwards
+        if reverse:
+            # The instance is an item, pk_set are galleries
+            gallery_ids = instance.galleries.values_list('pk', flat=True)
+            if pk_set is not None:
+                gallery_ids = gallery_ids.filter(pk__in=pk_set)
+            items = list(GalleryItemBase.objects.filter(pk=instance.pk).values(*SUMMARY_FIELDS))
+            instance._summary_removed = [(gallery_id, items) for gallery_id in gallery_ids]
+        else:
+            members = GalleryItemBase.objects.filter(galleries=instance)
+            if pk_set is not None:
+                members = members.filter(pk__in=pk_set)
+            instance._summary_removed = [(instance.pk, list(members.values(*SUMMARY_FIELDS)))]
+        return
+    if action in ('post_clear', 'post_remove'):
+        for gallery_id, items in getattr(instance, '_summary_removed', ()):
+            if items:
+                try:
+                    GallerySummary.objects.get(pk=gallery_id).items_removed(items)
+                except GallerySummary.DoesNotExist:
+                    pass
+                for item in items:
+                    GalleryNeighbours.remove(gallery_id, item['pk'])
+        instance._summary_removed = ()
+        return
+    if action == 'post_add' and pk_set:
+        if reverse:
+            items = list(GalleryItemBase.objects.filter(pk=instance.pk).values(*SUMMARY_FIELDS))
+            gallery_ids = pk_set
+        else:
+            items = list(GalleryItemBase.objects.filter(pk__in=pk_set).values(*SUMMARY_FIELDS))
+            gallery_ids = [instance.pk]
+        for summary in GallerySummary.objects.filter(pk__in=gallery_ids):
+            summary.items_added(items)
+        for gallery_id in gallery_ids:
+            if not neighbours_indexed(gallery_id):
+                GalleryNeighbours.rebuild(gallery_id)
+                continue
+            for item in items:
+                GalleryNeighbours.insert(gallery_id, item)
+
+def summary_item(instance):
+    return {'pk': instance.gallery_id, 'is_public': instance.is_public,
+            'is_thumbnail': instance.is_thumbnail, 'date_added': instance.date_added}
+
+def loaded_summary_item(instance):
+    """
+    Returns the summary fields of the item as loaded, None if it is new
+    or some of them were deferred.
+    """
+    values = instance.__dict__
+    if values.get('gallery_id') is None:
+        return None
+    if not all(name in values for name in ('is_public', 'is_thumbnail', 'date_added')):
+        return None
+    return summary_item(instance)
+
+def gallery_item_post_init(sender, instance, **kwargs):
+    # Compared after a save, instead of loading the row again before it
+    instance._summary_state = loaded_summary_item(instance)
+
+def gallery_item_post_save(sender, instance, created, **kwargs):
+    old = getattr(instance, '_summary_state', None)
+    item = instance._summary_state = summary_item(instance)
+    if created or old == item:
+        return
+    gallery_ids = list(instance.galleries.values_list('pk', flat=True))
+    for summary in GallerySummary.objects.filter(pk__in=gallery_ids).select_related('gallery'):
+        if old is None:
+            # Loaded with deferred fields, the old state is unknown
+            GallerySummary.rebuild(summary.gallery)
+        else:
+            summary.item_changed(old, item)
+    if old is None or (old['is_public'], old['date_added']) != (item['is_public'], item['date_added']):
+        # Published, hidden or re-dated, move it in the neighbour index
+        for gallery_id in gallery_ids:
+            if neighbours_indexed(gallery_id):
+                GalleryNeighbours.remove(gallery_id, item['pk'])
+                GalleryNeighbours.insert(gallery_id, item)
+
+def gallery_item_pre_delete(sender, instance, **kwargs):
+    gallery_ids = list(instance.galleries.values_list('pk', flat=True))
+    # Loaded before the deletion sets their cover and latest item to NULL
+    instance._summaries = list(GallerySummary.objects.filter(pk__in=gallery_ids))
+    # Link the neighbours to each other before the item disappears
+    for gallery_id in gallery_ids:
+        GalleryNeighbours.remove(gallery_id, instance.gallery_id)
+
+def gallery_item_post_delete(sender, instance, **kwargs):
+    for summary in getattr(instance, '_summaries', ()):
+        summary.items_removed([summary_item(instance)])
+
+def connect_gallery_item(model):
+    models.signals.post_init.connect(gallery_item_post_init, sender=model)
+    models.signals.post_save.connect(gallery_item_post_save, sender=model)
+
+def gallery_item_prepared(sender, **kwargs):
+    # Saves are signalled for the class of the saved object only
+    if issubclass(sender, GalleryItemBase):
+        connect_gallery_item(sender)
+
+models.signals.m2m_changed.connect(gallery_items_changed, sender=Gallery.items.through)
+models.signals.class_prepared.connect(gallery_item_prepared)
+connect_gallery_item(GalleryItemBase)
+# Deletes are signalled for every parent class, the GalleryItemBase part is enough
+models.signals.pre_delete.connect(gallery_item_pre_delete, sender=GalleryItemBase)
+models.signals.post_delete.connect(gallery_item_post_delete, sender=GalleryItemBase)
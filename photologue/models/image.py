@@ -1,3 +1,5 @@
+import hashlib
+import uuid
 from inspect import isclass
 from datetime import datetime
 
@@ -5,11 +7,12 @@ from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import make_aware, get_current_timezone
 from django.core.urlresolvers import reverse
+from django.utils import simplejson as json
 
 from photologue.default_settings import *
 from photologue.utils import EXIF
 from photologue.utils.reflection import add_reflection
-from photologue.utils.watermark import apply_watermark
+from photologue.utils.watermark import prepare_mark, watermark_layer, composite_layer
 from media import *
 
 import photologue.utils as utils
@@ -40,23 +43,63 @@ for n in dir(ImageFilter):
     if isclass(klass) and issubclass(klass, ImageFilter.BuiltinFilter) and \
         hasattr(klass, 'name'):
             filter_names.append(klass.__name__)
+# Errors of unreadable files and of malformed EXIF data
+EXIF_ERRORS = (EnvironmentError, ArithmeticError, IndexError, KeyError, TypeError, ValueError)
+# Watermark layers prepared for the image sizes
+WATERMARK_CACHE = utils.LRUCache(PHOTOLOGUE_WATERMARK_CACHE_SIZE)
+
 IMAGE_FILTERS_HELP_TEXT = _('Chain multiple filters using the following pattern "FILTER_ONE->FILTER_TWO->FILTER_THREE". Image filters will be applied in order. The following filters are available: %s.' % (', '.join(filter_names)))
 
 class ImageModel(MediaModel):
     effect = models.ForeignKey('ImageEffect', null=True, blank=True, related_name="%(class)s_related", verbose_name=_('effect'))
 
+    lazy_renditions = True
+
     class Meta:
         app_label=THIS_APP
 
     @property
     def EXIF(self):
+        record = self.get_exif_data()
+        if record is None:
+            return {}
+        return record.tags()
+
+    def get_exif_data(self):
+        """
+        Returns the stored EXIF record, None if it wasn't stored yet.
+        The records are stored on save and by the plexif command.
+        """
         try:
-            return EXIF.process_file(open(self.file.path, 'rb'))
-        except:
-            try:
-                return EXIF.process_file(open(self.file.path, 'rb'), details=False)
-            except:
-                return {}
+            return self.exif_data
+        except ImageExif.DoesNotExist:
+            return None
+
+    def update_exif(self):
+        """
+        Extracts the EXIF data from the file and stores them.
+        """
+        if not self.file or self._get_pk_val() is None:
+            return None
+        try:
+            with open(self.file.path, 'rb') as f:
+                try:
+                    tags = EXIF.process_file(f, lazy=True)
+                except EXIF_ERRORS:
+                    # Retry without the maker notes, they are the usual culprit
+                    f.seek(0)
+                    tags = EXIF.process_file(f, details=False, lazy=True)
+        except EXIF_ERRORS:
+            tags = {}
+        try:
+            record = ImageExif.objects.get(image=self)
+        except ImageExif.DoesNotExist:
+            record = ImageExif(image=self)
+        record.source = self.file.name
+        record.set_tags(tags)
+        record.save()
+        self.exif_data = record
+        return record
 
     def save(self, *args, **kwargs):
         # Save the original date
@@ -65,6 +108,12 @@ class ImageModel(MediaModel):
         # We have to save first,
         # this will update the file.path to right location
         super(ImageModel, self).save(*args, **kwargs)
+        # Extract EXIF of new files only once
+        try:
+            if self.exif_data.source != self.file.name:
+                self.update_exif()
+        except ImageExif.DoesNotExist:
+            self.update_exif()
         if date_taken is None:
             try:
                 exif_date = self.EXIF.get('EXIF DateTimeOriginal', None)
@@ -81,62 +130,226 @@ class ImageModel(MediaModel):
 
     def _get_SIZE_size(self, size):
         mediasize = MediaSizeCache().sizes.get(size)
-        if not self.size_exists(mediasize):
+        fingerprint = self.size_fingerprint(mediasize)
+        if not self.size_exists(mediasize, fingerprint):
             self.create_size(mediasize)
-        sizes = Image.open(self._get_SIZE_filename(size)).size
+        sizes = Image.open(self._get_SIZE_filename(size, fingerprint=fingerprint)).size
         return {'width': sizes[0], 'height': sizes[1]}
 
     def create_size(self, mediasize):
+        self.create_sizes([mediasize])
+
+    def pre_cache(self):
+        cache = MediaSizeCache()
+        self.create_sizes([mediasize for mediasize in cache.sizes.values() if mediasize.pre_cache])
+
+    def regenerate_sizes(self, mediasizes):
+        # The old files are served until the new ones are written
+        created = self.cached_size_names()
+        mediasizes = [mediasize for mediasize in mediasizes
+                        if mediasize.name in created or mediasize.pre_cache]
+        self.create_sizes(mediasizes, replace=True)
+
+    def create_sizes(self, mediasizes, replace=False):
+        """
+        Creates all the given sizes which are missing, or all of them
+        if replace is set.
+
+        Every source file (the original or an override) is decoded only once
+        and all the sizes are derived from the in-memory image, from the
+        largest to the smallest one.
+        """
         # Fail gracefully if we don't have an image.
         if not self.file:
             return
 
-        # Check if we got right size
-        if not hasattr(mediasize, 'imagesize'):
-            return
-        imagesize = mediasize.imagesize
-
-        if self.size_exists(imagesize):
+        # Check if we got right sizes
+        imagesizes = []
+        for mediasize in mediasizes:
+            # The related copy of an ImageSize may be older than the size itself
+            if isinstance(mediasize, ImageSize):
+                imagesize = mediasize
+            elif hasattr(mediasize, 'imagesize'):
+                imagesize = mediasize.imagesize
+            else:
+                continue
+            if replace or not self.size_exists(imagesize):
+                imagesizes.append(imagesize)
+        if not imagesizes:
             return
         if not os.path.isdir(self.cache_path()):
-            os.makedirs(self.cache_path())
+            try:
+                os.makedirs(self.cache_path())
+            except OSError:
+                # Created by another process meanwhile
+                if not os.path.isdir(self.cache_path()):
+                    raise
 
-        # check if we have overrides and use that instead
-        override = self.get_override(imagesize)
-        image_model_obj = override if override else self
+        # Only one process creates a size at a time, the others wait for it
+        locks = [utils.FileLock(self._get_lock_filename(imagesize), PHOTOLOGUE_RENDITION_LOCK_TIMEOUT)
+                    for imagesize in sorted(imagesizes, key=lambda imagesize: imagesize.name)]
+        try:
+            for lock in locks:
+                lock.acquire()
+            if not replace:
+                imagesizes = [imagesize for imagesize in imagesizes if not self.size_exists(imagesize)]
+
+            # check if we have overrides and use that instead
+            sources = {}
+            for imagesize in imagesizes:
+                override = self.get_override(imagesize)
+                image_model_obj = override if override else self
+                key = image_model_obj.file.path
+                sources.setdefault(key, (image_model_obj, []))[1].append(imagesize)
+            created = []
+            for image_model_obj, source_sizes in sources.values():
+                created += self._render_sizes(image_model_obj, source_sizes)
+        finally:
+            for lock in locks:
+                lock.release()
+        self._add_cached_sizes(created)
 
+    def _get_lock_filename(self, imagesize):
+        return os.path.join(self.cache_path(), '.%s.lock' % self._get_filename_for_size(imagesize))
+
+    def _render_sizes(self, image_model_obj, imagesizes):
         try:
             im = Image.open(image_model_obj.file.path)
         except IOError:
-            return
+            return []
+        # Decode JPEG at reduced resolution if all the sizes allow it
+        if im.format == 'JPEG' and all(imagesize.draft for imagesize in imagesizes):
+            draft_size = self._draft_size(im.size, image_model_obj, imagesizes)
+            if draft_size is not None:
+                im.draft(im.mode, draft_size)
         # Correct colorspace
         im = utils.colorspace(im)
         # Save the original format
         im_format = im.format
-        # Apply effect if found
-        if image_model_obj.effect is not None:
-            im = image_model_obj.effect.pre_process(im)
-        elif imagesize.effect is not None:
-            im = imagesize.effect.pre_process(im)
-        # Resize/crop image
-        if im.size != imagesize.size and imagesize.size != (0, 0):
-            im = image_model_obj.resize_image(im, imagesize)
-        # Apply watermark if found
-        if imagesize.watermark is not None:
-            im = imagesize.watermark.post_process(im)
-        # Save file
+        # Sizes sharing the same effect share the same base image
+        chains = {}
+        for imagesize in imagesizes:
+            effect = self._size_effect(image_model_obj, imagesize)
+            key = effect.pk if effect is not None else None
+            chains.setdefault(key, (effect, []))[1].append(imagesize)
+        created = []
+        for effect, chain in chains.values():
+            base = effect.pre_process(im) if effect is not None else im
+            params = effect.resize_params(base) if effect is not None else None
+            created += self._render_chain(base, chain, image_model_obj.crop_from, im_format, effect, params)
+        return created
+
+    def _size_effect(self, image_model_obj, imagesize):
+        effect = getattr(image_model_obj, 'effect', None)
+        if effect is None:
+            effect = getattr(imagesize, 'effect', None)
+        return effect
+
+    def size_fingerprint(self, mediasize):
+        override = self.get_override(mediasize)
+        image_model_obj = override if override else self
+        effect = self._size_effect(image_model_obj, mediasize)
+        watermark = getattr(mediasize, 'watermark', None)
+        values = [mediasize.parameters(), image_model_obj.crop_from,
+                  (override.pk, override.file.name) if override else None,
+                  effect.parameters() if effect is not None else None,
+                  watermark.parameters() if watermark is not None else None]
+        return hashlib.sha1(repr(values)).hexdigest()[:FINGERPRINT_LENGTH]
+
+    def _draft_size(self, size, image_model_obj, imagesizes):
+        """
+        Returns the smallest size the image can be decoded to, while keeping
+        PHOTOLOGUE_DRAFT_MARGIN times the resolution of every target size.
+        Returns None if the image has to be decoded in full.
+        """
+        width, height = 0, 0
+        for imagesize in imagesizes:
+            effect = self._size_effect(image_model_obj, imagesize)
+            # Rotating effects are applied before the resize
+            rotated = getattr(effect, 'transpose_method', '') in ('ROTATE_90', 'ROTATE_270')
+            source = (size[1], size[0]) if rotated else size
+            if source == imagesize.size or imagesize.size == (0, 0):
+                return None
+            geometry = self._resize_geometry(source, imagesize, image_model_obj.crop_from)
+            if geometry is None:
+                return None
+            (new_width, new_height), box = geometry
+            if rotated:
+                new_width, new_height = new_height, new_width
+            width = max(width, new_width * PHOTOLOGUE_DRAFT_MARGIN)
+            height = max(height, new_height * PHOTOLOGUE_DRAFT_MARGIN)
+        if width >= size[0] or height >= size[1]:
+            return None
+        return (width, height)
+
+    def _render_chain(self, base, imagesizes, crop_from, im_format, effect=None, params=None):
+        # Resize from the largest size to the smallest one,
+        # so each resize can start from the nearest larger intermediate.
+        geometries = []
+        for imagesize in imagesizes:
+            if base.size != imagesize.size and imagesize.size != (0, 0):
+                geometry = self._resize_geometry(base.size, imagesize, crop_from)
+            else:
+                geometry = None
+            geometries.append((geometry, imagesize))
+        def largest_first(item):
+            geometry = item[0]
+            if geometry is None:
+                # Kept in the source size, no intermediates are needed
+                return 0
+            (width, height), box = geometry
+            return -width * height
+        geometries.sort(key=largest_first)
+        intermediates = []
+        created = []
+        for geometry, imagesize in geometries:
+            if geometry is None:
+                im = base
+            else:
+                dimensions, box = geometry
+                source = base
+                for intermediate in intermediates:
+                    if intermediate.size[0] >= dimensions[0] and \
+                       intermediate.size[1] >= dimensions[1]:
+                        source = intermediate
+                im = source.resize(dimensions, Image.ANTIALIAS)
+                intermediates.append(im)
+                if box is not None:
+                    im = im.crop(box)
+            if effect is not None:
+                im = effect.post_resize(im, params)
+            # Apply watermark if found
+            if imagesize.watermark is not None:
+                im = imagesize.watermark.post_process(im)
+            self._save_size(im, imagesize, im_format)
+            created.append(imagesize.name)
+        return created
+
+    def _save_size(self, im, imagesize, im_format):
         im_filename = getattr(self, "get_%s_filename" % imagesize.name)()
+        # Written aside and renamed, readers never see a partial file
+        directory, name = os.path.split(im_filename)
+        base, ext = os.path.splitext(name)
+        tmp_filename = os.path.join(directory, '.%s.%s%s' % (base, uuid.uuid4().hex[:8], ext))
         try:
             if im_format != 'JPEG':
-                im.save(im_filename)
-            im.save(im_filename, 'JPEG', quality=int(imagesize.quality), optimize=True)
-        except IOError, e:
-            if os.path.isfile(im_filename):
-                os.unlink(im_filename)
+                im.save(tmp_filename)
+            im.save(tmp_filename, 'JPEG', quality=int(imagesize.quality), optimize=True)
+            os.rename(tmp_filename, im_filename)
+        except (IOError, OSError), e:
+            if os.path.isfile(tmp_filename):
+                os.unlink(tmp_filename)
             raise e
 
-    def resize_image(self, im, imagesize):
-        cur_width, cur_height = im.size
+    def _resize_geometry(self, size, imagesize, crop_from=None):
+        """
+        Returns the dimensions an image of the given size should be resized to
+        and the box it should be cropped to afterwards (or None).
+        Returns None if the image should be left as it is.
+        """
+        if crop_from is None:
+            crop_from = self.crop_from
+        cur_width, cur_height = size
         new_width, new_height = imagesize.size
         if imagesize.crop:
             ratio = max(float(new_width)/cur_width,float(new_height)/cur_height)
@@ -146,39 +359,173 @@ class ImageModel(MediaModel):
             yd = abs(new_height - y)
             x_diff = int(xd / 2)
             y_diff = int(yd / 2)
-            if self.crop_from == 'top':
+            if crop_from == 'top':
                 box = (int(x_diff), 0, int(x_diff+new_width), new_height)
-            elif self.crop_from == 'left':
+            elif crop_from == 'left':
                 box = (0, int(y_diff), new_width, int(y_diff+new_height))
-            elif self.crop_from == 'bottom':
+            elif crop_from == 'bottom':
                 box = (int(x_diff), int(yd), int(x_diff+new_width), int(y)) # y - yd = new_height
-            elif self.crop_from == 'right':
+            elif crop_from == 'right':
                 box = (int(xd), int(y_diff), int(x), int(y_diff+new_height)) # x - xd = new_width
             else:
                 box = (int(x_diff), int(y_diff), int(x_diff+new_width), int(y_diff+new_height))
-            im = im.resize((int(x), int(y)), Image.ANTIALIAS).crop(box)
+            return ((int(x), int(y)), box)
+        if not new_width == 0 and not new_height == 0:
+            ratio = min(float(new_width)/cur_width,
+                        float(new_height)/cur_height)
         else:
-            if not new_width == 0 and not new_height == 0:
-                ratio = min(float(new_width)/cur_width,
-                            float(new_height)/cur_height)
+            if new_width == 0:
+                ratio = float(new_height)/cur_height
             else:
-                if new_width == 0:
-                    ratio = float(new_height)/cur_height
-                else:
-                    ratio = float(new_width)/cur_width
-            new_dimensions = (int(round(cur_width*ratio)),
-                              int(round(cur_height*ratio)))
-            if new_dimensions[0] > cur_width or \
-               new_dimensions[1] > cur_height:
-                if not imagesize.upscale:
-                    return im
-            im = im.resize(new_dimensions, Image.ANTIALIAS)
+                ratio = float(new_width)/cur_width
+        new_dimensions = (int(round(cur_width*ratio)),
+                          int(round(cur_height*ratio)))
+        if new_dimensions[0] > cur_width or \
+           new_dimensions[1] > cur_height:
+            if not imagesize.upscale:
+                return None
+        return (new_dimensions, None)
+
+    def resize_image(self, im, imagesize):
+        geometry = self._resize_geometry(im.size, imagesize)
+        if geometry is None:
+            return im
+        dimensions, box = geometry
+        im = im.resize(dimensions, Image.ANTIALIAS)
+        if box is not None:
+            im = im.crop(box)
         return im
 
+def exif_ratio(tags, name):
+    """
+    Value of a rational (or integer) tag as float, None if it is missing.
+    """
+    try:
+        value = tags[name].values[0]
+        if isinstance(value, EXIF.Ratio):
+            return float(value.num) / value.den
+        return float(value)
+    except (KeyError, IndexError, TypeError, ValueError, ZeroDivisionError):
+        return None
+
+def exif_coordinate(tags, name):
+    """
+    GPS coordinate in degrees, negative for south and west.
+    """
+    try:
+        degrees, minutes, seconds = [float(v.num) / v.den for v in tags['GPS ' + name].values]
+    except (KeyError, ValueError, AttributeError, ZeroDivisionError):
+        return None
+    value = degrees + minutes / 60 + seconds / 3600
+    if tags.get('GPS %sRef' % name) and str(tags['GPS %sRef' % name].printable).strip() in ('S', 'W'):
+        value = -value
+    return value
+
+def exif_string(tags, name):
+    try:
+        return str(tags[name].printable).strip()[:100]
+    except KeyError:
+        return ''
+
+def exif_encode(value):
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin-1')
+    if isinstance(value, EXIF.Ratio):
+        return {'num': value.num, 'den': value.den}
+    return value
+
+def exif_decode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return EXIF.Ratio(value['num'], value['den'])
+    return value
+
+class ImageExif(models.Model):
+    """
+    EXIF data of an image, extracted once when the image file is saved.
+
+    All the tags are stored as JSON, the commonly searched ones have
+    their own columns.
+    """
+    # Tags too big or useless to be stored
+    SKIP_TAGS = ('JPEGThumbnail', 'TIFFThumbnail', 'EXIF MakerNote')
+
+    image = models.OneToOneField(ImageModel, primary_key=True, related_name='exif_data')
+    source = models.CharField(_('source'), max_length=255, blank=True, editable=False, help_text=_('The file the data were read from.'))
+    data = models.TextField(_('data'), blank=True, default='', editable=False)
+    camera_make = models.CharField(_('camera make'), max_length=100, blank=True, db_index=True)
+    camera_model = models.CharField(_('camera model'), max_length=100, blank=True, db_index=True)
+    lens = models.CharField(_('lens'), max_length=100, blank=True, db_index=True)
+    exposure_time = models.FloatField(_('exposure time'), null=True, blank=True, db_index=True, help_text=_('In seconds.'))
+    f_number = models.FloatField(_('f-number'), null=True, blank=True, db_index=True)
+    iso = models.PositiveIntegerField(_('ISO'), null=True, blank=True, db_index=True)
+    focal_length = models.FloatField(_('focal length'), null=True, blank=True, db_index=True, help_text=_('In millimeters.'))
+    latitude = models.FloatField(_('latitude'), null=True, blank=True, db_index=True)
+    longitude = models.FloatField(_('longitude'), null=True, blank=True, db_index=True)
+    altitude = models.FloatField(_('altitude'), null=True, blank=True)
+    orientation = models.PositiveSmallIntegerField(_('orientation'), null=True, blank=True, db_index=True)
+
+    class Meta:
+        app_label=THIS_APP
+        verbose_name = _("EXIF data")
+        verbose_name_plural = _("EXIF data")
+
+    def __unicode__(self):
+        return unicode(self.image_id)
+
+    def tags(self):
+        """
+        The stored tags, in the form EXIF.process_file returns them.
+        """
+        if not hasattr(self, '_tags'):
+            self._tags = {}
+            for name, (printable, tag, field_type, values) in json.loads(self.data or '{}').items():
+                if isinstance(values, list):
+                    values = [exif_decode(v) for v in values]
+                else:
+                    values = exif_decode(values)
+                self._tags[name.encode('utf-8')] = EXIF.IFD_Tag(exif_decode(printable), tag, field_type, values, 0, 0)
+        return self._tags
+
+    def set_tags(self, tags):
+        data = {}
+        for name, tag in tags.items():
+            if name in self.SKIP_TAGS or not isinstance(tag, EXIF.IFD_Tag):
+                continue
+            if isinstance(tag.values, (list, tuple)):
+                values = [exif_encode(v) for v in tag.values]
+            else:
+                values = exif_encode(tag.values)
+            data[name] = (exif_encode(tag.printable), tag.tag, tag.field_type, values)
+        self.data = json.dumps(data)
+        self._tags = dict((name, tag) for name, tag in tags.items() if name in data)
+
+        self.camera_make = exif_string(tags, 'Image Make')
+        self.camera_model = exif_string(tags, 'Image Model')
+        self.lens = exif_string(tags, 'EXIF LensModel')
+        self.exposure_time = exif_ratio(tags, 'EXIF ExposureTime')
+        self.f_number = exif_ratio(tags, 'EXIF FNumber')
+        iso = exif_ratio(tags, 'EXIF ISOSpeedRatings')
+        self.iso = int(iso) if iso is not None else None
+        self.focal_length = exif_ratio(tags, 'EXIF FocalLength')
+        self.latitude = exif_coordinate(tags, 'GPSLatitude')
+        self.longitude = exif_coordinate(tags, 'GPSLongitude')
+        self.altitude = exif_ratio(tags, 'GPS GPSAltitude')
+        if self.altitude is not None and exif_ratio(tags, 'GPS GPSAltitudeRef') == 1:
+            # Below sea level
+            self.altitude = -self.altitude
+        orientation = exif_ratio(tags, 'Image Orientation')
+        self.orientation = int(orientation) if orientation is not None else None
+
 class ImageSize(MediaSize):
     effect = models.ForeignKey('ImageEffect', null=True, blank=True, related_name='media_sizes', verbose_name=_('image effect'))
     quality = models.PositiveIntegerField(_('quality'), choices=JPEG_QUALITY_CHOICES, default=70, help_text=_('JPEG image quality.'))
     watermark = models.ForeignKey('Watermark', null=True, blank=True, related_name='media_sizes', verbose_name=_('watermark image'))
+    draft = models.BooleanField(_('fast decode?'), default=False, help_text=_('If selected, large JPEG images are decoded at 1/2, 1/4 or 1/8 of their resolution before the final resize. This is much faster, but effect filters are applied to the reduced image.'))
 
     class Meta:
         app_label=THIS_APP
@@ -227,19 +574,45 @@ class ImageEffect(ImageBaseEffect):
         if self.transpose_method != '':
             method = getattr(Image, self.transpose_method)
             im = im.transpose(method)
+        if not self.resize_invariant():
+            im = self.adjust(im)
+        return im
+
+    def resize_params(self, im):
+        # The contrast is relative to the mean of the whole image,
+        # not of the resized or cropped one
+        if self.resize_invariant() and self.contrast != 1.0 and im.mode in ('RGB', 'RGBA'):
+            return {'mean': utils.adjusted_mean(im, self.color, self.brightness)}
+        return None
+
+    def post_resize(self, im, params=None):
+        if self.resize_invariant():
+            im = self.adjust(im, (params or {}).get('mean'))
+        return im
+
+    def image_filters(self):
+        return [image_filter for image_filter in [getattr(ImageFilter, name.upper(), None)
+                    for name in self.filters.split('->')] if image_filter is not None]
+
+    def resize_invariant(self):
+        """
+        Checks if the adjustments give the same result on the resized image,
+        which is true for the per pixel color adjustments. The sharpness
+        and filters depend on the resolution.
+        """
+        return self.sharpness == 1.0 and not self.image_filters()
+
+    def adjust(self, im, mean=None):
         if im.mode != 'RGB' and im.mode != 'RGBA':
             return im
-        for name in ['Color', 'Brightness', 'Contrast', 'Sharpness']:
-            factor = getattr(self, name.lower())
-            if factor != 1.0:
-                im = getattr(ImageEnhance, name)(im).enhance(factor)
-        for name in self.filters.split('->'):
-            image_filter = getattr(ImageFilter, name.upper(), None)
-            if image_filter is not None:
-                try:
-                    im = im.filter(image_filter)
-                except ValueError:
-                    pass
+        im = utils.adjust_colors(im, self.color, self.brightness, self.contrast, mean)
+        if self.sharpness != 1.0:
+            im = ImageEnhance.Sharpness(im).enhance(self.sharpness)
+        for image_filter in self.image_filters():
+            try:
+                im = im.filter(image_filter)
+            except ValueError:
+                pass
         return im
 
     def post_process(self, im):
@@ -258,5 +631,23 @@ class Watermark(ImageBaseEffect):
         verbose_name_plural = _('watermarks')
 
     def post_process(self, im):
-        mark = Image.open(self.image.path)
-        return apply_watermark(im, mark, self.style, self.opacity)
+        layer = self.get_layer(im.size)
+        return composite_layer(im, layer)
+
+    def get_layer(self, size):
+        """
+        Returns the watermark drawn in a layer of the given size, the layers
+        are cached until the watermark or its image changes.
+        """
+        key = (self.pk, os.path.getmtime(self.image.path), size, self.style, self.opacity)
+        layer = WATERMARK_CACHE.get(key)
+        if layer is None:
+            mark_key = key[:2] + (None,) + key[3:]
+            mark = WATERMARK_CACHE.get(mark_key)
+            if mark is None:
+                mark = prepare_mark(Image.open(self.image.path), self.opacity)
+                mark.load()
+                WATERMARK_CACHE.set(mark_key, mark, utils.image_cost(mark))
+            layer = watermark_layer(size, mark, self.style)
+            WATERMARK_CACHE.set(key, layer, utils.image_cost(layer))
+        return layer
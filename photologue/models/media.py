@@ -1,13 +1,47 @@
+import operator
+import threading
+import uuid
+import warnings
+
 from django.db import models
-from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.core.cache import get_cache
+from django.core.signals import request_started
+from django.core.urlresolvers import reverse
+from django.core.exceptions import ValidationError, ObjectDoesNotExist
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.utils.functional import curry
 from django.utils.timezone import now
 from django.utils.encoding import smart_str, force_unicode
+from django.utils import simplejson as json
 
 from photologue.default_settings import *
+from photologue.utils import viewcount, is_shared_cache
+
+# Accessors available for every size, as get_<size>_<accessor>
+SIZE_ACCESSORS = ('mediasize', 'filename', 'size', 'url')
+
+# Length of the parameter fingerprints in the file names of the sizes
+FINGERPRINT_LENGTH = 8
+
+def model_size_applies(model, mediasize):
+    related_model = type(mediasize).__name__.split('.')[-1].lower().replace('size', 'model')
+    return related_model in [x.__name__.lower() for x in model.mro()]
+
+def split_size_accessor(name):
+    """
+    Splits "get_<size>_<accessor>" to (size, accessor), returns None
+    if the name is not a size accessor name.
+    """
+    if not name.startswith('get_'):
+        return None
+    for accessor in SIZE_ACCESSORS:
+        suffix = '_' + accessor
+        if name.endswith(suffix) and len(name) > len('get_') + len(suffix):
+            return (name[len('get_'):-len(suffix)], accessor)
+    return None
 
 class MediaModel(models.Model):
     file = models.FileField(_('file'), max_length=MEDIA_FIELD_MAX_LENGTH,
@@ -15,6 +49,11 @@ class MediaModel(models.Model):
     date_taken = models.DateTimeField(_('date taken'), null=True, blank=True)
     view_count = models.PositiveIntegerField(default=0, editable=False)
     crop_from = models.CharField(_('crop from'), blank=True, max_length=10, default='center', choices=CROP_ANCHOR_CHOICES)
+    cached_sizes = models.TextField(_('cached sizes'), blank=True, default='', editable=False)
+    override_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Sizes can be created by the rendition view, see PHOTOLOGUE_LAZY_RENDITIONS
+    lazy_renditions = False
 
     class Meta:
         app_label=THIS_APP
@@ -29,6 +68,24 @@ class MediaModel(models.Model):
     def __str__(self):
         return self.__unicode__()
 
+    def __getattr__(self, name):
+        # Methods to access sized media (urls, paths) are resolved
+        # on demand, instead of being added to each instance.
+        parts = split_size_accessor(name)
+        if parts is not None:
+            size, accessor = parts
+            mediasize = MediaSizeCache().sizes.get(size)
+            if mediasize is not None and self.size_applies(mediasize):
+                return curry(getattr(self, '_get_SIZE_%s' % accessor), size=size)
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, name))
+
+    def size_applies(self, mediasize):
+        """
+        Checks if the size can be used with this object,
+        ImageSize for ImageModel, VideoSize for VideoModel etc.
+        """
+        return model_size_applies(type(self), mediasize)
+
     def admin_thumbnail(self, dest_url=None):
         func = getattr(self, 'get_admin_thumbnail_url', None)
         if func is None:
@@ -62,75 +119,170 @@ class MediaModel(models.Model):
 
     def _get_SIZE_url(self, size):
         mediasize = MediaSizeCache().sizes.get(size)
-        if not self.size_exists(mediasize):
-            self.create_size(mediasize)
-        if not self.file: 
-            return
-        if not os.path.isfile(self._get_SIZE_filename(size)):
+        if not self.file:
             return
+        # Computed once, it may need the overrides and the effect
+        fingerprint = self.size_fingerprint(mediasize)
+        if not self.size_exists(mediasize, fingerprint):
+            if PHOTOLOGUE_LAZY_RENDITIONS and self.lazy_renditions and self._get_pk_val() is not None:
+                if mediasize.increment_count:
+                    self.increment_count()
+                return self.get_rendition_url(mediasize)
+            self.create_size(mediasize)
+            if not self.size_exists(mediasize, fingerprint):
+                return
         if mediasize.increment_count:
             self.increment_count()
-        return '/'.join([self.cache_url(), self._get_filename_for_size(mediasize.name)])
+        return '/'.join([self.cache_url(), self._get_filename_for_size(mediasize, fingerprint)])
+
+    def get_rendition_url(self, mediasize):
+        """
+        Returns the url of the view creating and serving the size.
+        """
+        return reverse('pl-rendition', kwargs={'model': self._meta.object_name.lower(),
+                                                'pk': self._get_pk_val(), 'size': mediasize.name})
 
     def _get_SIZE_filename(self, size, *args, **kwargs):
         mediasize = MediaSizeCache().sizes.get(size)
         return smart_str(os.path.join(self.cache_path(),
                             self._get_filename_for_size(mediasize.name, *args, **kwargs)))
 
-    def add_accessor_methods(self, *args, **kwargs):
-        for size in MediaSizeCache().sizes.values():
-            related_model = type(size).__name__.split('.')[-1].lower().replace('size', 'model')
-            ok = False
-            for anc in [x.__name__.lower() for x in type(self).mro()]:
-                if anc == related_model:
-                    ok = True
-            if not ok:
-                continue
-            setattr(self, 'get_%s_size' % size.name,
-                    curry(self._get_SIZE_size, size=size.name))
-            setattr(self, 'get_%s_mediasize' % size.name,
-                    curry(self._get_SIZE_mediasize, size=size.name))
-            setattr(self, 'get_%s_url' % size.name,
-                    curry(self._get_SIZE_url, size=size.name))
-            setattr(self, 'get_%s_filename' % size.name,
-                        curry(self._get_SIZE_filename, size=size.name))
-
-    def _get_filename_for_size(self, size):
+    def _get_filename_for_size(self, size, fingerprint=None):
+        mediasize = size if hasattr(size, 'name') else MediaSizeCache().sizes.get(size)
         size = getattr(size, 'name', size)
         base, ext = os.path.splitext(self.media_filename())
+        if fingerprint is None:
+            fingerprint = self.size_fingerprint(mediasize) if mediasize is not None else ''
+        if fingerprint:
+            return ''.join([base, '_', size, '_', fingerprint, ext])
         return ''.join([base, '_', size, ext])
 
+    def size_fingerprint(self, mediasize):
+        """
+        Returns a short hash of everything the size of this object is rendered
+        from, it is a part of the file name. When any of the parameters
+        changes the size gets a new name, so the files never change and
+        the old ones are removed later by the plcleanup command.
+        An empty fingerprint keeps the plain name.
+        """
+        return ''
+
     def increment_count(self):
-        self.view_count += 1
-        models.Model.save(self)
+        # The instance keeps its value, the views are written in batches
+        viewcount.increment(self.id)
+
+    def cached_size_names(self):
+        """
+        Returns the names of the sizes already created for this object,
+        in any version.
+        """
+        return set(self.cached_size_fingerprints())
 
-    def size_exists(self, mediasize):
+    def cached_size_fingerprints(self):
+        """
+        Returns the fingerprints of the created sizes by the size name.
+        """
+        fingerprints = {}
+        for item in self.cached_sizes.split():
+            name, sep, fingerprint = item.partition(':')
+            fingerprints[name] = fingerprint
+        return fingerprints
+
+    def _set_cached_sizes(self, fingerprints):
+        value = ' '.join(sorted('%s:%s' % (name, fingerprint) if fingerprint else name
+                                    for name, fingerprint in dict(fingerprints).items()))
+        if value == self.cached_sizes:
+            return
+        self.cached_sizes = value
+        # Update just this column, the rest of the object may be stale.
+        # Concurrent updates may lose a name, it is found again
+        # by size_exists() on the next access.
+        if self.id is not None:
+            MediaModel.objects.filter(id=self.id).update(cached_sizes=value)
+
+    def _add_cached_sizes(self, names):
+        fingerprints = self.cached_size_fingerprints()
+        sizes = MediaSizeCache().sizes
+        for name in names:
+            mediasize = sizes.get(name)
+            fingerprints[name] = self.size_fingerprint(mediasize) if mediasize is not None else ''
+        self._set_cached_sizes(fingerprints)
+
+    def _remove_cached_sizes(self, names):
+        fingerprints = self.cached_size_fingerprints()
+        for name in names:
+            fingerprints.pop(name, None)
+        self._set_cached_sizes(fingerprints)
+
+    def size_exists(self, mediasize, fingerprint=None):
+        """
+        Checks if the current version of the size was created, the fingerprint
+        of the size is computed unless it is given.
+        """
+        if fingerprint is None:
+            fingerprint = self.size_fingerprint(mediasize)
+        if self.cached_size_fingerprints().get(mediasize.name) == fingerprint:
+            return True
         func = getattr(self, "get_%s_filename" % mediasize.name, None)
         if func is not None:
             try:
                 if os.path.isfile(func()):
+                    # Created outside of create_size, remember it
+                    self._add_cached_sizes([mediasize.name])
                     return True
             except ValueError:
                 return False
         return False
 
+    def prune_cached_sizes(self):
+        """
+        Forgets the current sizes listed as created whose files are missing,
+        e.g. removed by hand, so they are created again. Returns their names.
+        Deleted sizes and old versions are left to the plregenerate command.
+        """
+        sizes = MediaSizeCache().sizes
+        missing = []
+        for name, fingerprint in self.cached_size_fingerprints().items():
+            mediasize = sizes.get(name)
+            if mediasize is None or fingerprint != self.size_fingerprint(mediasize):
+                continue
+            try:
+                if not os.path.isfile(getattr(self, "get_%s_filename" % name)()):
+                    missing.append(name)
+            except ValueError:
+                continue
+        self._remove_cached_sizes(missing)
+        return missing
+
+    def get_overrides(self):
+        """
+        Returns a dictionary of the MediaOverride objects of this object,
+        keyed by the mediasize id. The result is kept on the instance,
+        prefetch_overrides() fills it for many objects at once.
+        """
+        if not hasattr(self, '_overrides'):
+            if self.override_count:
+                prefetch_overrides([self])
+            else:
+                self._overrides = {}
+        return self._overrides
+
     def get_override(self, mediasize):
         """
         Returns the first MediaOverride object found for this object and mediasize.
         """
-        content_type = ContentType.objects.get_for_model(self)
-        overrides = MediaOverride.objects.filter(object_id=self.id, content_type=content_type, mediasize=mediasize)
-        if overrides:
-            return overrides[0]
-        else:
+        if not self.override_count:
             return None
+        return self.get_overrides().get(mediasize.id)
 
-    def remove_size(self, mediasize, remove_dirs=True):
+    def remove_size(self, mediasize, remove_dirs=True, update_cached=True):
         if not self.size_exists(mediasize):
             return
         filename = getattr(self, "get_%s_filename" % mediasize.name)()
         if os.path.isfile(filename):
             os.remove(filename)
+        if update_cached:
+            self._remove_cached_sizes([mediasize.name])
         if remove_dirs:
             self.remove_cache_dirs()
 
@@ -141,7 +293,8 @@ class MediaModel(models.Model):
             return
         cache = MediaSizeCache()
         for mediasize in cache.sizes.values():
-            self.remove_size(mediasize, False)
+            self.remove_size(mediasize, False, False)
+        self._set_cached_sizes({})
         self.remove_cache_dirs()
 
     def pre_cache(self):
@@ -150,6 +303,26 @@ class MediaModel(models.Model):
             if mediasize.pre_cache:
                 self.create_size(mediasize)
 
+    def regenerate_sizes(self, mediasizes):
+        """
+        Renders the given sizes again after their definition changed.
+        Sizes not created yet are skipped, unless they are pre-cached.
+        """
+        for mediasize in mediasizes:
+            if not self.size_applies(mediasize):
+                continue
+            if mediasize.name in self.cached_size_names() or mediasize.pre_cache:
+                self.remove_size(mediasize, remove_dirs=False)
+                self.create_size(mediasize)
+
+    def rendition_filenames(self):
+        """
+        Returns the file names of the current versions of all the sizes
+        of this object, created or not.
+        """
+        return set(self._get_filename_for_size(mediasize) for mediasize in MediaSizeCache().sizes.values()
+                        if self.size_applies(mediasize))
+
     def remove_cache_dirs(self):
         try:
             os.removedirs(self.cache_path())
@@ -162,6 +335,11 @@ class MediaModel(models.Model):
         if self._get_pk_val():
             remove_deleted = getattr(self, 'remove_deleted', PHOTOLOGUE_REMOVE_DELETED)
             orig = MediaModel.objects.get(id=self.mediamodel_ptr_id)
+            if orig.file.path == self.file.path:
+                # Views and created sizes are stored by single column updates,
+                # the instance may be stale
+                self.view_count = orig.view_count
+                self.cached_sizes = orig.cached_sizes
             if remove_deleted and orig.file.path != self.file.path:
                 # Try deleting original video
                 try:
@@ -170,6 +348,7 @@ class MediaModel(models.Model):
                     pass
                 orig.prevent_cache_clear = getattr(self, 'prevent_cache_clear', False)
                 orig.clear_cache()
+                self.cached_sizes = orig.cached_sizes
         super(MediaModel, self).save(*args, **kwargs)
         self.pre_cache()
 
@@ -184,15 +363,148 @@ class MediaModel(models.Model):
             pass
         super(MediaModel, self).delete()
 
+class MediaOverrideQuerySet(models.query.QuerySet):
+    def update(self, **kwargs):
+        if 'content_type' not in kwargs and 'object_id' not in kwargs:
+            return super(MediaOverrideQuerySet, self).update(**kwargs)
+        # Overrides moved to other objects, recount both the old and new ones
+        pks = list(self.values_list('pk', flat=True))
+        targets = set(self.values_list('content_type', 'object_id'))
+        rows = super(MediaOverrideQuerySet, self).update(**kwargs)
+        targets.update(MediaOverride.objects.filter(pk__in=pks).values_list('content_type', 'object_id'))
+        for content_type_id, object_id in targets:
+            count_overrides(content_type_id, object_id)
+        return rows
+
+class MediaOverrideManager(models.Manager):
+    def get_query_set(self):
+        return MediaOverrideQuerySet(self.model)
+
 class MediaOverride(MediaModel):
     content_type = models.ForeignKey('contenttypes.ContentType')
     object_id = models.PositiveIntegerField()
     content_object = generic.GenericForeignKey("content_type", "object_id")
     mediasize = models.ForeignKey('MediaSize', blank=False)
 
+    objects = MediaOverrideManager()
+
     class Meta:
         app_label=THIS_APP
 
+    def pre_cache(self):
+        # Overrides are only the source of the sizes of their object
+        pass
+
+    def save(self, *args, **kwargs):
+        if self._get_pk_val():
+            targets = list(MediaOverride.objects.filter(pk=self.pk).values_list('content_type', 'object_id'))
+        else:
+            targets = []
+        super(MediaOverride, self).save(*args, **kwargs)
+        for content_type_id, object_id in set(targets + [(self.content_type_id, self.object_id)]):
+            count_overrides(content_type_id, object_id)
+
+def media_override_post_delete(sender, instance, **kwargs):
+    # Also sent for every override removed by a queryset or cascade delete
+    count_overrides(instance.content_type_id, instance.object_id)
+
+models.signals.post_delete.connect(media_override_post_delete, sender=MediaOverride)
+
+def render_parameters(obj, exclude=()):
+    # Normalized, a value assigned as 0 is the same as 0.0 loaded from the database
+    return [(field.name, force_unicode(field.to_python(field.value_from_object(obj))))
+                for field in obj._meta.fields if field.name not in exclude and not field.primary_key]
+
+def cached_size_regex(name):
+    """
+    Returns the regular expression matching the manifests (cached_sizes)
+    holding the size, e.g. not the "thumbnail" size for the "thumb" size.
+    """
+    return r'(^| )%s(:| |$)' % name
+
+def media_models():
+    """
+    Returns the concrete MediaModel subclasses having sizes
+    (ImageModel, Photo, VideoModel, Video).
+    """
+    return [model for model in models.get_models()
+                if issubclass(model, MediaModel) and model is not MediaModel
+                    and not issubclass(model, MediaOverride)]
+
+def media_queryset(model):
+    """
+    Returns the objects of the media model, which are not objects of any
+    of its subclasses. Every object is found once, in its most specific
+    class (the one its overrides are attached to), for the models returned
+    by media_models().
+    """
+    queryset = model._default_manager.all()
+    for rel in model._meta.get_all_related_objects():
+        if issubclass(rel.model, model) and rel.field.rel.parent_link:
+            queryset = queryset.filter(**{'%s__isnull' % rel.get_accessor_name(): True})
+    return queryset
+
+def pk_ordering(model):
+    """
+    Returns the lookup ordering the model by its primary key. For inherited
+    models plain 'pk' would order by the default ordering of the parent.
+    """
+    field = model._meta.pk
+    names = [field.name]
+    while field.rel is not None:
+        field = field.rel.to._meta.get_field(field.rel.field_name)
+        names.append(field.name)
+    return '__'.join(names)
+
+def count_overrides(content_type_id, object_id):
+    """
+    Stores the number of overrides on the object they belong to.
+    """
+    try:
+        obj = ContentType.objects.get_for_id(content_type_id).get_object_for_this_type(pk=object_id)
+    except ObjectDoesNotExist:
+        return
+    if not isinstance(obj, MediaModel):
+        return
+    count = MediaOverride.objects.filter(content_type=content_type_id, object_id=object_id).count()
+    MediaModel.objects.filter(id=getattr(obj, 'mediamodel_ptr_id', obj.pk)).update(override_count=count)
+
+def override_map(items):
+    """
+    Loads the MediaOverride objects of all the given items in one query,
+    returns a dictionary {(content_type_id, object_id): {mediasize_id: override}}.
+    Items without any override are not queried at all.
+    """
+    lookups = {}
+    for item in items:
+        if item.override_count:
+            content_type = ContentType.objects.get_for_model(item)
+            lookups.setdefault(content_type.id, set()).add(item.pk)
+    result = {}
+    if not lookups:
+        return result
+    query = reduce(operator.or_, [Q(content_type=content_type_id, object_id__in=object_ids)
+                    for content_type_id, object_ids in lookups.items()])
+    for override in MediaOverride.objects.filter(query).order_by('-pk'):
+        # Ordered backwards, so the first override for each size wins
+        overrides = result.setdefault((override.content_type_id, override.object_id), {})
+        overrides[override.mediasize_id] = override
+    return result
+
+def prefetch_overrides(items):
+    """
+    Resolves the overrides of many items at once, get_override() then
+    doesn't touch the database for any of them.
+    """
+    overrides = override_map(items)
+    for item in items:
+        if item.override_count:
+            key = (ContentType.objects.get_for_model(item).id, item.pk)
+            item._overrides = overrides.get(key, {})
+        else:
+            item._overrides = {}
+    return items
+
 class MediaSize(models.Model):
     name = models.CharField(_('name'), max_length=64, unique=False, help_text=_('Size name should contain only letters, numbers and underscores. Examples: "thumbnail", "display", "small", "main_page_widget".'))
     width = models.PositiveIntegerField(_('width'), default=0, help_text=_('If width is set to "0" the media will be scaled to the supplied height.'))
@@ -238,23 +550,42 @@ class MediaSize(models.Model):
             raise ValidationError(errors)
 
     def clear_cache(self):
-        for cls in MediaModel.__subclasses__():
-            if not cls._meta.abstract:
-                for obj in cls.objects.all():
-                    obj.remove_size(self)
-                    if self.pre_cache:
-                        obj.create_size(self)
         MediaSizeCache().reset()
+        self.regenerate()
 
     def save(self, *args, **kwargs):
+        created = self._get_pk_val() is None
         super(MediaSize, self).save(*args, **kwargs)
         MediaSizeCache().reset()
-        self.clear_cache()
+        if not created or self.pre_cache:
+            self.regenerate()
+
+    def regenerate(self):
+        """
+        Queues rendering this size again for all the objects, the plregenerate
+        command does it. The changed size has a new fingerprint, so objects
+        shown before the job reaches them render it on demand. The files of
+        the old version are removed by the plcleanup command.
+        """
+        for model in media_models():
+            if model_size_applies(model, self):
+                RegenerationJob.enqueue(model, self)
 
     def delete(self):
         assert self._get_pk_val() is not None, "%s object can't be deleted because its %s attribute is set to None." % (self._meta.object_name, self._meta.pk.attname)
-        self.clear_cache()
         super(MediaSize, self).delete()
+        MediaSizeCache().reset()
+        # The objects forget the size in the plregenerate command,
+        # its files are removed by the plcleanup command
+        for model in media_models():
+            if model_size_applies(model, self):
+                RegenerationJob.enqueue(model, size_name=self.name, cached_sizes__regex=cached_size_regex(self.name))
+
+    def parameters(self):
+        """
+        Returns the values the size is rendered with, for fingerprints.
+        """
+        return render_parameters(self, ('name', 'pre_cache', 'increment_count'))
 
     def _get_size(self):
         return (self.width, self.height)
@@ -263,27 +594,168 @@ class MediaSize(models.Model):
     size = property(_get_size, _set_size)
 
 
+class RegenerationJob(models.Model):
+    content_type = models.ForeignKey('contenttypes.ContentType', help_text=_('The media objects to render again.'))
+    lookup = models.TextField(_('lookup'), blank=True, default='{}', help_text=_('JSON encoded filter of the objects.'))
+    mediasize = models.ForeignKey('MediaSize', null=True, blank=True, related_name='regeneration_jobs',
+                    help_text=_('The size to render again, all sizes of the objects if empty.'))
+    size_name = models.CharField(_('deleted size'), max_length=64, blank=True, default='',
+                    help_text=_('Name of a deleted size, which the objects forget instead.'))
+    created = models.DateTimeField(_('created'), default=now)
+    started = models.DateTimeField(_('started'), null=True, blank=True)
+    finished = models.DateTimeField(_('finished'), null=True, blank=True)
+    worker = models.CharField(_('worker'), max_length=100, blank=True, default='', help_text=_('The worker which claimed this job.'))
+    lease = models.DateTimeField(_('lease'), null=True, blank=True, help_text=_('The job is reserved for the worker until this date.'))
+    checkpoint = models.PositiveIntegerField(_('checkpoint'), null=True, blank=True,
+                    help_text=_('Primary key of the last object done, the job continues after it.'))
+    done = models.PositiveIntegerField(_('done'), default=0, help_text=_('Number of objects done.'))
+    total = models.PositiveIntegerField(_('total'), default=0, help_text=_('Number of objects when the job started.'))
+    errors = models.PositiveIntegerField(_('errors'), default=0, help_text=_('Number of objects which failed.'))
+
+    class Meta:
+        app_label=THIS_APP
+        ordering = ['created']
+        verbose_name = _("regeneration job")
+        verbose_name_plural = _("regeneration jobs")
+
+    def __unicode__(self):
+        if self.size_name:
+            return u'%s: %s %s' % (self.content_type, _('deleted'), self.size_name)
+        return u'%s: %s' % (self.content_type, self.mediasize or _('all sizes'))
+
+    @classmethod
+    def enqueue(cls, model, mediasize=None, size_name='', **lookup):
+        """
+        Queues a job for the objects of the model matching the lookup,
+        unless the same job is queued already and not started yet.
+        """
+        content_type = ContentType.objects.get_for_model(model)
+        lookup = json.dumps(lookup, sort_keys=True)
+        pending = cls.objects.filter(content_type=content_type, mediasize=mediasize, size_name=size_name,
+                                     lookup=lookup, started=None)
+        if pending.exists():
+            return pending[0]
+        return cls.objects.create(content_type=content_type, mediasize=mediasize, size_name=size_name, lookup=lookup)
+
+    def get_queryset(self):
+        model = self.content_type.model_class()
+        lookup = dict((str(key), value) for key, value in json.loads(self.lookup).items())
+        return media_queryset(model).filter(**lookup).order_by(pk_ordering(model))
+
+    def get_sizes(self):
+        """
+        Returns the current definitions of the sizes to render.
+        """
+        if self.size_name:
+            return []
+        sizes = MediaSizeCache().sizes.values()
+        if self.mediasize_id is not None:
+            sizes = [size for size in sizes if size.pk == self.mediasize_id]
+        return sizes
+
+    def process(self, obj, sizes):
+        """
+        Renders the sizes of the object again, or makes it forget the deleted size.
+        """
+        if self.size_name:
+            obj._remove_cached_sizes([self.size_name])
+        else:
+            obj.regenerate_sizes(sizes)
+
+    def progress(self):
+        if self.finished is not None:
+            return 100.0
+        if not self.total:
+            return 0.0
+        return min(100.0, 100.0 * self.done / self.total)
+
+SIZE_VERSION_KEY = 'photologue-sizes-version'
+SIZE_VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+def size_cache():
+    cache = get_cache(PHOTOLOGUE_SIZE_CACHE)
+    if not is_shared_cache(cache):
+        warnings.warn('PHOTOLOGUE_SIZE_CACHE is a local memory or dummy cache, other processes '
+                      'do not see changed sizes. Use a cache shared by all processes.', RuntimeWarning)
+    return cache
+
+def load_sizes():
+    """
+    Returns all the sizes by name, each one as its most specific class
+    (ImageSize, VideoSize), loaded with a single joined query.
+    """
+    subclasses = []
+    related = []
+    for rel in MediaSize._meta.get_all_related_objects():
+        if not issubclass(rel.model, MediaSize) or not rel.field.rel.parent_link:
+            continue
+        name = rel.get_accessor_name()
+        subclasses.append(name)
+        related.append(name)
+        # Effects and watermarks of the sizes come with the same query
+        for field in rel.model._meta.local_fields:
+            if isinstance(field, models.ForeignKey) and not field.rel.parent_link:
+                related.append('%s__%s' % (name, field.name))
+    sizes = {}
+    for size in MediaSize.objects.select_related(*related):
+        sizes[size.name] = size
+        for name in subclasses:
+            try:
+                subclass = getattr(size, name)
+            except ObjectDoesNotExist:
+                continue
+            if subclass is not None:
+                sizes[size.name] = subclass
+                break
+    return sizes
+
 class MediaSizeCache(object):
-    __state = {"sizes": {}}
+    """
+    All the sizes by name, shared by all the threads of the process.
+
+    The sizes are an immutable snapshot, it is replaced as a whole and
+    never modified. Saving a size changes the generation stamp in the
+    PHOTOLOGUE_SIZE_CACHE, every process compares it with the stamp of its
+    snapshot once per request and loads the sizes again when it differs.
+    """
+    _snapshot = None
+    _lock = threading.Lock()
 
     def __init__(self):
-        self.__dict__ = self.__state
-        if not len(self.sizes):
-            sizes = MediaSize.objects.all()
-            for size in sizes:
-                related = False
-                for subclass in size._meta.get_all_related_objects():
-                    name = subclass.get_accessor_name()
-                    if name.endswith('size') and hasattr(size, name):
-                        if not related:
-                            related = getattr(size, name)
-                if related:
-                    self.sizes[size.name] = related
-                else:
-                    self.sizes[size.name] = size
+        snapshot = MediaSizeCache._snapshot
+        if snapshot is None:
+            snapshot = MediaSizeCache.load()
+        self.version, self.sizes = snapshot
+
+    @classmethod
+    def load(cls):
+        with cls._lock:
+            if cls._snapshot is None:
+                # Read the stamp first, a change made during the query is not missed
+                version = size_cache().get(SIZE_VERSION_KEY)
+                cls._snapshot = (version, load_sizes())
+            return cls._snapshot
+
+    @classmethod
+    def check_version(cls):
+        """
+        Drops the snapshot if the sizes were changed by another process.
+        """
+        snapshot = cls._snapshot
+        if snapshot is not None and size_cache().get(SIZE_VERSION_KEY) != snapshot[0]:
+            with cls._lock:
+                if cls._snapshot is snapshot:
+                    cls._snapshot = None
 
     def reset(self):
-        self.sizes = {}
+        size_cache().set(SIZE_VERSION_KEY, uuid.uuid4().hex, SIZE_VERSION_TIMEOUT)
+        with MediaSizeCache._lock:
+            MediaSizeCache._snapshot = None
+
+def check_size_version(sender, **kwargs):
+    MediaSizeCache.check_version()
+
+request_started.connect(check_size_version)
 
 class BaseEffect(models.Model):
     name = models.CharField(_('name'), max_length=50, unique=True)
@@ -307,8 +779,30 @@ class BaseEffect(models.Model):
     def post_process(self, im):
         return im
 
+    def parameters(self):
+        """
+        Returns the values the effect is applied with, for fingerprints.
+        """
+        return render_parameters(self, ('name', 'description'))
+
+    def resize_params(self, im):
+        """
+        Returns what post_resize() needs to know about the whole image
+        (after pre_process), computed once for all its sizes.
+        """
+        return None
+
+    def post_resize(self, im, params=None):
+        """
+        Applied to each size after it is resized, before the watermark.
+        Parts of the effect giving the same result on the resized image
+        are cheaper here.
+        """
+        return im
+
     def process(self, im):
         im = self.pre_process(im)
+        im = self.post_resize(im, self.resize_params(im))
         im = self.post_process(im)
         return im
 
@@ -325,14 +819,17 @@ class BaseEffect(models.Model):
             pass
         models.Model.save(self, *args, **kwargs)
         self.create_sample()
-        #FIXME
-        for size in self.photo_sizes.all():
-            size.clear_cache()
-        # try to clear all related subclasses of ImageModel
-        for prop in [prop for prop in dir(self) if prop[-8:] == '_related']:
-            for obj in getattr(self, prop).all():
-                obj.clear_cache()
-                obj.pre_cache()
+        # The cached sizes hold the effect
+        MediaSizeCache().reset()
+        for size in self.media_sizes.all():
+            size.regenerate()
+        # Objects with this effect, in all related subclasses of ImageModel
+        for rel in self._meta.get_all_related_objects():
+            if not rel.get_accessor_name().endswith('_related'):
+                continue
+            for model in media_models():
+                if issubclass(model, rel.model):
+                    RegenerationJob.enqueue(model, **{rel.field.name: self.pk})
 
     def delete(self):
         try:
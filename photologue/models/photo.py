@@ -4,9 +4,11 @@ from django.utils.translation import ugettext_lazy as _
 from photologue.default_settings import *
 
 from image import ImageModel
-from gallery import GalleryItemBase
+from gallery import GalleryItemBase, GalleryItemManager
 
 class Photo(GalleryItemBase, ImageModel):
+    objects = GalleryItemManager()
+
     class Meta:
         app_label=THIS_APP
         verbose_name = _("photo")
@@ -4,13 +4,12 @@ from django.db import models
 from django.db.models.base import ModelBase
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now, is_aware, make_aware, get_current_timezone
-from django.utils.functional import curry
 
 from photologue.default_settings import *
 from photologue.utils.video import video_info, video_calculate_size
 from media import *
 from image import ImageModel, ImageSize
-from gallery import GalleryItemBase
+from gallery import GalleryItemBase, GalleryItemManager
 
 try:
     from dateutil import parser
@@ -140,7 +139,7 @@ class VideoModel(MediaModel):
             return
         return {'width': width, 'height': height}
 
-    def _get_filename_for_size(self, size, invalid_ok=False):
+    def _get_filename_for_size(self, size, fingerprint=None, invalid_ok=False):
         if hasattr(size, 'name'):
             # size is class
             size_name = size.name
@@ -154,17 +153,21 @@ class VideoModel(MediaModel):
         base, ext = os.path.splitext(self.media_filename())
         return ''.join([base, '_', size_name, '.', mediasize.videotype])
 
-    def add_accessor_methods(self, *args, **kwargs):
-        super(VideoModel, self).add_accessor_methods(*args, **kwargs)
-        if not self.poster:
-            return
-        for size in MediaSizeCache().sizes.values():
-            if type(size) != ImageSize:
-                continue
-            for func in ['get_%s_size', 'get_%s_mediasize', 'get_%s_url', 'get_%s_filename']:
-                func = func % size.name
-                if not hasattr(self, func):
-                    setattr(self, func, curry(getattr(self.poster, func)))
+    def rendition_filenames(self):
+        # Also the sizes being converted
+        return set(self._get_filename_for_size(mediasize, invalid_ok=True)
+                        for mediasize in MediaSizeCache().sizes.values() if self.size_applies(mediasize))
+
+    def __getattr__(self, name):
+        try:
+            return super(VideoModel, self).__getattr__(name)
+        except AttributeError:
+            # Image sizes are provided by the poster
+            parts = split_size_accessor(name)
+            if parts is not None and self.__dict__.get('poster_id') is not None:
+                if type(MediaSizeCache().sizes.get(parts[0])) == ImageSize:
+                    return getattr(self.poster, name)
+            raise
 
     def create_size(self, mediasize):
         # Fail gracefully if we don't have an video.
@@ -215,9 +218,9 @@ class VideoSize(MediaSize):
     def save(self, *args, **kwargs):
         if not self.pre_cache:
             self.pre_cache = True
-        MediaSizeCache().reset()
         # Skip MediaSize save - prevent clearing caches
         super(MediaSize, MediaSize).save(self, *args, **kwargs)
+        MediaSizeCache().reset()
 
     def validate_unique(self, exclude=None):
         # Check as usual
@@ -252,6 +255,14 @@ class VideoConvert(models.Model):
     inprogress = models.BooleanField(_('in progress'))
     converted = models.BooleanField(_('converted'))
     message = models.TextField(_('message'), null=True, blank=True)
+    worker = models.CharField(_('worker'), max_length=100, blank=True, default='', help_text=_('The worker which claimed this convert.'))
+    lease = models.DateTimeField(_('lease'), null=True, blank=True, help_text=_('The convert is reserved for the worker until this date.'))
+    heartbeat = models.DateTimeField(_('heartbeat'), null=True, blank=True, help_text=_('The last time the worker extended the lease.'))
+    attempts = models.PositiveIntegerField(_('attempts'), default=0, help_text=_('Number of failed or abandoned conversions.'))
+    retry_after = models.DateTimeField(_('retry after'), null=True, blank=True, help_text=_('The convert will not be retried before this date.'))
+    progress = models.FloatField(_('progress'), default=0, help_text=_('Percent of the conversion done.'))
+    fps = models.FloatField(_('fps'), null=True, blank=True, help_text=_('Frames encoded per second.'))
+    eta = models.DateTimeField(_('ETA'), null=True, blank=True, help_text=_('Estimated date the conversion finishes.'))
 
     class Meta:
         app_label=THIS_APP
@@ -263,6 +274,8 @@ class VideoConvert(models.Model):
         return unicode(self.video)
 
 class Video(GalleryItemBase, VideoModel):
+    objects = GalleryItemManager()
+
     class Meta:
         app_label=THIS_APP
         verbose_name = _("video")
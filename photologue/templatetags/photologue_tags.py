@@ -9,6 +9,14 @@ register = template.Library()
 def model_url(urlname, model_type, *args, **kwargs):
     return reverse(urlname.replace('TYPE', model_type), args=args)
 
+@register.filter
+def sample(gallery, count):
+    """
+    Returns count random items of the gallery, the count may be given
+    as a slice, like ":5"
+    """
+    return gallery.sample(int(str(count).lstrip(':')))
+
 @register.inclusion_tag('photologue/gallery_item.html')
 def next_in_gallery(item, gallery):
     return {'item': item.get_next_in_gallery(gallery), 'nodiv': True}
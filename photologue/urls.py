@@ -1,6 +1,6 @@
 from django.conf import settings
 from django.conf.urls.defaults import *
-from views import ajax_archive_index
+from views import ajax_archive_index, rendition
 from models import *
 
 # Number of random images from the gallery to display.
@@ -69,3 +69,6 @@ def gen_patterns(prefix, date_field, slug_field, model, template, common_detail)
 urlpatterns = gen_patterns('gallery', 'date_added', 'title_slug', Gallery, u'gallery', True)
 urlpatterns += gen_patterns('photo', 'date_added', 'title_slug', Photo, u'media', False)
 urlpatterns += gen_patterns('video', 'date_added', 'title_slug', Video, u'media', False)
+urlpatterns += patterns('',
+    url(r'^rendition/(?P<model>\w+)/(?P<pk>\d+)/(?P<size>\w+)/$', rendition, name='pl-rendition'),
+)
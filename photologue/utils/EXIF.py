@@ -22,6 +22,10 @@
 #
 # These 2 are useful when you are retrieving a large list of images
 #
+# To read the EXIF data into memory at once and decode the tags only
+# when they are looked up, pass the -l or --lazy argument, or as
+#    tags = EXIF.process_file(f, lazy=True)
+#
 #
 # To return an error on invalid tags,
 # pass the -s or --strict argument, or as
@@ -83,6 +87,9 @@
 #
 
 
+import mmap
+from UserDict import DictMixin
+
 # Don't throw an exception when given an out of range character.
 def make_string(seq):
     str = ''
@@ -367,6 +374,10 @@ EXIF_TAGS = {
               2: 'Hard'}),
     0xA40B: ('DeviceSettingDescription', ),
     0xA40C: ('SubjectDistanceRange', ),
+    0xA432: ('LensSpecification', ),
+    0xA433: ('LensMake', ),
+    0xA434: ('LensModel', ),
+    0xA435: ('LensSerialNumber', ),
     0xA500: ('Gamma', ),
     0xC4A5: ('PrintIM', ),
     0xEA1C:	('Padding', ),
@@ -1238,22 +1249,36 @@ class IFD_Tag:
 
 # class that handles an EXIF header
 class EXIF_header:
-    def __init__(self, file, endian, offset, fake_exif, strict, debug=0):
+    # with a buffer (string or mmap) given, the data are read from it instead
+    # of the file, in lazy mode the tags are decoded on first lookup
+    def __init__(self, file, endian, offset, fake_exif, strict, debug=0,
+                 buffer=None, lazy=False):
         self.file = file
+        self.buffer = buffer
+        self.lazy = lazy
         self.endian = endian
         self.offset = offset
         self.fake_exif = fake_exif
         self.strict = strict
         self.debug = debug
-        self.tags = {}
+        if lazy:
+            self.tags = LazyTags(self)
+        else:
+            self.tags = {}
+
+    # read length bytes at the offset
+    def read(self, offset, length):
+        if self.buffer is not None:
+            return self.buffer[self.offset+offset:self.offset+offset+length]
+        self.file.seek(self.offset+offset)
+        return self.file.read(length)
 
     # convert slice to integer, based on sign and endian flags
     # usually this offset is assumed to be relative to the beginning of the
     # start of the EXIF information.  For some cameras that use relative tags,
     # this offset may be relative to some other starting point.
     def s2n(self, offset, length, signed=0):
-        self.file.seek(self.offset+offset)
-        slice=self.file.read(length)
+        slice=self.read(offset, length)
         if self.endian == 'I':
             val=s2n_intel(slice)
         else:
@@ -1295,6 +1320,7 @@ class EXIF_header:
         return a
 
     # return list of entries in this IFD
+    # returns True when the stop_tag was reached
     def dump_IFD(self, ifd, ifd_name, dict=EXIF_TAGS, relative=0, stop_tag='UNDEF'):
         entries=self.s2n(ifd, 2)
         for i in range(entries):
@@ -1320,100 +1346,120 @@ class EXIF_header:
                     else:
                         raise ValueError('unknown type %d in tag 0x%04X' % (field_type, tag))
 
-                typelen = FIELD_TYPES[field_type][0]
-                count = self.s2n(entry + 4, 4)
-                # Adjust for tag id/type/count (2+2+4 bytes)
-                # Now we point at either the data or the 2nd level offset
-                offset = entry + 8
-
-                # If the value fits in 4 bytes, it is inlined, else we
-                # need to jump ahead again.
-                if count * typelen > 4:
-                    # offset is not the value; it's a pointer to the value
-                    # if relative we set things up so s2n will seek to the right
-                    # place when it adds self.offset.  Note that this 'relative'
-                    # is for the Nikon type 3 makernote.  Other cameras may use
-                    # other relative offsets, which would have to be computed here
-                    # slightly differently.
-                    if relative:
-                        tmp_offset = self.s2n(offset, 4)
-                        offset = tmp_offset + ifd - 8
-                        if self.fake_exif:
-                            offset = offset + 18
-                    else:
-                        offset = self.s2n(offset, 4)
-
-                field_offset = offset
-                if field_type == 2:
-                    # special case: null-terminated ASCII string
-                    # XXX investigate
-                    # sometimes gets too big to fit in int value
-                    if count != 0 and count < (2**31):
-                        self.file.seek(self.offset + offset)
-                        values = self.file.read(count)
-                        #print values
-                        # Drop any garbage after a null.
-                        values = values.split('\x00', 1)[0]
-                    else:
-                        values = ''
+                if self.lazy:
+                    # decode it on first lookup
+                    self.tags[ifd_name + ' ' + tag_name] = LazyTag(self.endian, self.offset,
+                                                                   ifd, entry, tag, tag_name,
+                                                                   tag_entry, field_type, relative)
                 else:
-                    values = []
-                    signed = (field_type in [6, 8, 9, 10])
-                    
-                    # XXX investigate
-                    # some entries get too big to handle could be malformed
-                    # file or problem with self.s2n
-                    if count < 1000:
-                        for dummy in range(count):
-                            if field_type in (5, 10):
-                                # a ratio
-                                value = Ratio(self.s2n(offset, 4, signed),
-                                              self.s2n(offset + 4, 4, signed))
-                            else:
-                                value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
-                    # The test above causes problems with tags that are 
-                    # supposed to have long values!  Fix up one important case.
-                    elif tag_name == 'MakerNote' :
-                        for dummy in range(count):
-                            value = self.s2n(offset, typelen, signed)
-                            values.append(value)
-                            offset = offset + typelen
-                    #else :
-                    #    print "Warning: dropping large tag:", tag, tag_name
-                
-                # now 'values' is either a string or an array
-                if count == 1 and field_type != 2:
-                    printable=str(values[0])
-                elif count > 50 and len(values) > 20 :
-                    printable=str( values[0:20] )[0:-1] + ", ... ]"
-                else:
-                    printable=str(values)
-
-                # compute printable version of values
-                if tag_entry:
-                    if len(tag_entry) != 1:
-                        # optional 2nd tag element is present
-                        if callable(tag_entry[1]):
-                            # call mapping function
-                            printable = tag_entry[1](values)
-                        else:
-                            printable = ''
-                            for i in values:
-                                # use lookup table for this tag
-                                printable += tag_entry[1].get(i, repr(i))
-
-                self.tags[ifd_name + ' ' + tag_name] = IFD_Tag(printable, tag,
-                                                          field_type,
-                                                          values, field_offset,
-                                                          count * typelen)
-                if self.debug:
-                    print ' debug:   %s: %s' % (tag_name,
-                                                repr(self.tags[ifd_name + ' ' + tag_name]))
+                    self.tags[ifd_name + ' ' + tag_name] = self.decode_tag(ifd, entry, tag, tag_name,
+                                                                           tag_entry, field_type, relative)
+                    if self.debug:
+                        print ' debug:   %s: %s' % (tag_name,
+                                                    repr(self.tags[ifd_name + ' ' + tag_name]))
 
             if tag_name == stop_tag:
-                break
+                return True
+        return False
+
+    # decode a tag postponed by the lazy mode
+    def decode_lazy(self, lazy):
+        # MakerNotes may use their own endian and offset
+        endian, offset = self.endian, self.offset
+        self.endian, self.offset = lazy.endian, lazy.offset
+        try:
+            return self.decode_tag(lazy.ifd, lazy.entry, lazy.tag, lazy.tag_name,
+                                   lazy.tag_entry, lazy.field_type, lazy.relative)
+        finally:
+            self.endian, self.offset = endian, offset
+
+    # decode values of the IFD entry
+    def decode_tag(self, ifd, entry, tag, tag_name, tag_entry, field_type, relative):
+        typelen = FIELD_TYPES[field_type][0]
+        count = self.s2n(entry + 4, 4)
+        # Adjust for tag id/type/count (2+2+4 bytes)
+        # Now we point at either the data or the 2nd level offset
+        offset = entry + 8
+
+        # If the value fits in 4 bytes, it is inlined, else we
+        # need to jump ahead again.
+        if count * typelen > 4:
+            # offset is not the value; it's a pointer to the value
+            # if relative we set things up so s2n will seek to the right
+            # place when it adds self.offset.  Note that this 'relative'
+            # is for the Nikon type 3 makernote.  Other cameras may use
+            # other relative offsets, which would have to be computed here
+            # slightly differently.
+            if relative:
+                tmp_offset = self.s2n(offset, 4)
+                offset = tmp_offset + ifd - 8
+                if self.fake_exif:
+                    offset = offset + 18
+            else:
+                offset = self.s2n(offset, 4)
+
+        field_offset = offset
+        if field_type == 2:
+            # special case: null-terminated ASCII string
+            # XXX investigate
+            # sometimes gets too big to fit in int value
+            if count != 0 and count < (2**31):
+                values = self.read(offset, count)
+                #print values
+                # Drop any garbage after a null.
+                values = values.split('\x00', 1)[0]
+            else:
+                values = ''
+        else:
+            values = []
+            signed = (field_type in [6, 8, 9, 10])
+            
+            # XXX investigate
+            # some entries get too big to handle could be malformed
+            # file or problem with self.s2n
+            if count < 1000:
+                for dummy in range(count):
+                    if field_type in (5, 10):
+                        # a ratio
+                        value = Ratio(self.s2n(offset, 4, signed),
+                                      self.s2n(offset + 4, 4, signed))
+                    else:
+                        value = self.s2n(offset, typelen, signed)
+                    values.append(value)
+                    offset = offset + typelen
+            # The test above causes problems with tags that are 
+            # supposed to have long values!  Fix up one important case.
+            elif tag_name == 'MakerNote' :
+                for dummy in range(count):
+                    value = self.s2n(offset, typelen, signed)
+                    values.append(value)
+                    offset = offset + typelen
+            #else :
+            #    print "Warning: dropping large tag:", tag, tag_name
+        
+        # now 'values' is either a string or an array
+        if count == 1 and field_type != 2:
+            printable=str(values[0])
+        elif count > 50 and len(values) > 20 :
+            printable=str( values[0:20] )[0:-1] + ", ... ]"
+        else:
+            printable=str(values)
+
+        # compute printable version of values
+        if tag_entry:
+            if len(tag_entry) != 1:
+                # optional 2nd tag element is present
+                if callable(tag_entry[1]):
+                    # call mapping function
+                    printable = tag_entry[1](values)
+                else:
+                    printable = ''
+                    for i in values:
+                        # use lookup table for this tag
+                        printable += tag_entry[1].get(i, repr(i))
+
+        return IFD_Tag(printable, tag, field_type, values, field_offset,
+                       count * typelen)
 
     # extract uncompressed TIFF thumbnail (like pulling teeth)
     # we take advantage of the pre-existing layout in the thumbnail IFD as
@@ -1426,8 +1472,7 @@ class EXIF_header:
         else:
             tiff = 'II*\x00\x08\x00\x00\x00'
         # ... plus thumbnail IFD data plus a null "next IFD" pointer
-        self.file.seek(self.offset+thumb_ifd)
-        tiff += self.file.read(entries*12+2)+'\x00\x00\x00\x00'
+        tiff += self.read(thumb_ifd, entries*12+2)+'\x00\x00\x00\x00'
 
         # fix up large value offset pointers into data area
         for i in range(entries):
@@ -1454,8 +1499,7 @@ class EXIF_header:
                     strip_off = newoff
                     strip_len = 4
                 # get original data and store it
-                self.file.seek(self.offset + oldoff)
-                tiff += self.file.read(count * typelen)
+                tiff += self.read(oldoff, count * typelen)
 
         # add pixel strips and update strip offset info
         old_offsets = self.tags['Thumbnail StripOffsets'].values
@@ -1466,8 +1510,7 @@ class EXIF_header:
             tiff = tiff[:strip_off] + offset + tiff[strip_off + strip_len:]
             strip_off += strip_len
             # add pixel strip to end
-            self.file.seek(self.offset + old_offsets[i])
-            tiff += self.file.read(old_counts[i])
+            tiff += self.read(old_offsets[i], old_counts[i])
 
         self.tags['TIFFThumbnail'] = tiff
 
@@ -1592,10 +1635,50 @@ class EXIF_header:
             self.tags['MakerNote '+name]=IFD_Tag(str(val), None, 0, None,
                                                  None, None)
 
+# tag postponed by the lazy mode
+class LazyTag(object):
+    __slots__ = ('endian', 'offset', 'ifd', 'entry', 'tag', 'tag_name',
+                 'tag_entry', 'field_type', 'relative')
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+# tags dictionary of the lazy mode, decodes the tags on first lookup
+class LazyTags(DictMixin):
+    def __init__(self, header):
+        self.header = header
+        self.data = {}
+
+    def __getitem__(self, key):
+        value = self.data[key]
+        if isinstance(value, LazyTag):
+            value = self.data[key] = self.header.decode_lazy(value)
+        return value
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def keys(self):
+        return self.data.keys()
+
 # process an image file (expects an open file object)
 # this is the function that has to deal with all the arbitrary nasty bits
 # of the EXIF standard
-def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
+#
+# In lazy mode the EXIF segment of a JPEG (or a TIFF file mapped to memory)
+# is read at once and parsed from memory, the tags are decoded on first
+# lookup. The file is not used once the function returns.
+def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False, lazy=False):
     # yah it's cheesy...
     global detailed
     detailed = details
@@ -1622,7 +1705,13 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
         if data[2] == '\xFF' and data[6:10] == 'Exif':
             # detected EXIF header
             offset = f.tell()
-            endian = f.read(1)
+            if lazy:
+                # segment length includes the length and the Exif marker
+                length = ord(data[4])*256+ord(data[5])
+                buffer = f.read(length-8)
+                endian = buffer[0:1]
+            else:
+                endian = f.read(1)
         else:
             # no EXIF information
             return {}
@@ -1630,10 +1719,22 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
         # file format not recognized
         return {}
 
+    if not lazy:
+        buffer = None
+    elif offset == 0:
+        # TIFF file, map it instead of reading it
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, EnvironmentError, ValueError):
+            f.seek(0)
+            buffer = f.read()
+
     # deal with the EXIF info we found
     if debug:
         print {'I': 'Intel', 'M': 'Motorola'}[endian], 'format'
-    hdr = EXIF_header(f, endian, offset, fake_exif, strict, debug)
+    # the buffer starts at the EXIF header
+    hdr = EXIF_header(f, endian, 0 if lazy else offset, fake_exif, strict, debug,
+                      buffer, lazy)
     ifd_list = hdr.list_IFDs()
     ctr = 0
     for i in ifd_list:
@@ -1646,27 +1747,32 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
             IFD_name = 'IFD %d' % ctr
         if debug:
             print ' IFD %d (%s) at offset %d:' % (ctr, IFD_name, i)
-        hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag)
+        # nothing else is needed once the stop_tag is found
+        if hdr.dump_IFD(i, IFD_name, stop_tag=stop_tag):
+            return hdr.tags
         # EXIF IFD
         exif_off = hdr.tags.get(IFD_name+' ExifOffset')
         if exif_off:
             if debug:
                 print ' EXIF SubIFD at offset %d:' % exif_off.values[0]
-            hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag)
+            if hdr.dump_IFD(exif_off.values[0], 'EXIF', stop_tag=stop_tag):
+                return hdr.tags
             # Interoperability IFD contained in EXIF IFD
             intr_off = hdr.tags.get('EXIF SubIFD InteroperabilityOffset')
             if intr_off:
                 if debug:
                     print ' EXIF Interoperability SubSubIFD at offset %d:' \
                           % intr_off.values[0]
-                hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
-                             dict=INTR_TAGS, stop_tag=stop_tag)
+                if hdr.dump_IFD(intr_off.values[0], 'EXIF Interoperability',
+                                dict=INTR_TAGS, stop_tag=stop_tag):
+                    return hdr.tags
         # GPS IFD
         gps_off = hdr.tags.get(IFD_name+' GPSInfo')
         if gps_off:
             if debug:
                 print ' GPS SubIFD at offset %d:' % gps_off.values[0]
-            hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag)
+            if hdr.dump_IFD(gps_off.values[0], 'GPS', dict=GPS_TAGS, stop_tag=stop_tag):
+                return hdr.tags
         ctr += 1
 
     # extract uncompressed TIFF thumbnail
@@ -1677,9 +1783,8 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     # JPEG thumbnail (thankfully the JPEG data is stored as a unit)
     thumb_off = hdr.tags.get('Thumbnail JPEGInterchangeFormat')
     if thumb_off:
-        f.seek(offset+thumb_off.values[0])
         size = hdr.tags['Thumbnail JPEGInterchangeFormatLength'].values[0]
-        hdr.tags['JPEGThumbnail'] = f.read(size)
+        hdr.tags['JPEGThumbnail'] = hdr.read(thumb_off.values[0], size)
 
     # deal with MakerNote contained in EXIF IFD
     # (Some apps use MakerNote tags but do not use a format for which we
@@ -1692,8 +1797,7 @@ def process_file(f, stop_tag='UNDEF', details=True, strict=False, debug=False):
     if 'JPEGThumbnail' not in hdr.tags:
         thumb_off=hdr.tags.get('MakerNote JPEGThumbnail')
         if thumb_off:
-            f.seek(offset+thumb_off.values[0])
-            hdr.tags['JPEGThumbnail']=file.read(thumb_off.field_length)
+            hdr.tags['JPEGThumbnail']=hdr.read(thumb_off.values[0], thumb_off.field_length)
 
     return hdr.tags
 
@@ -1704,6 +1808,7 @@ def usage(exit_status):
     msg += 'Extract EXIF information from digital camera image files.\n\nOptions:\n'
     msg += '-q --quick   Do not process MakerNotes.\n'
     msg += '-t TAG --stop-tag TAG   Stop processing when this tag is retrieved.\n'
+    msg += '-l --lazy   Parse from memory, decode tags on lookup.\n'
     msg += '-s --strict   Run in strict mode (stop on errors).\n'
     msg += '-d --debug   Run in debug mode (display extra info).\n'
     print msg
@@ -1716,7 +1821,7 @@ if __name__ == '__main__':
 
     # parse command line options/arguments
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hqsdt:v", ["help", "quick", "strict", "debug", "stop-tag="])
+        opts, args = getopt.getopt(sys.argv[1:], "hqsdlt:v", ["help", "quick", "strict", "debug", "lazy", "stop-tag="])
     except getopt.GetoptError:
         usage(2)
     if args == []:
@@ -1725,6 +1830,7 @@ if __name__ == '__main__':
     stop_tag = 'UNDEF'
     debug = False
     strict = False
+    lazy = False
     for o, a in opts:
         if o in ("-h", "--help"):
             usage(0)
@@ -1736,6 +1842,8 @@ if __name__ == '__main__':
             strict = True
         if o in ("-d", "--debug"):
             debug = True
+        if o in ("-l", "--lazy"):
+            lazy = True
 
     # output info for each file
     for filename in args:
@@ -1746,7 +1854,7 @@ if __name__ == '__main__':
             continue
         print filename + ':'
         # get the tags
-        data = process_file(file, stop_tag=stop_tag, details=detailed, strict=strict, debug=debug)
+        data = process_file(file, stop_tag=stop_tag, details=detailed, strict=strict, debug=debug, lazy=lazy)
         if not data:
             print 'No EXIF information found'
             continue
@@ -1,3 +1,18 @@
+import os
+import errno
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# Inter-process file locks are not available everywhere
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 # Required PIL classes may or may not be available from the root namespace
 # depending on the installation method used.
 try:
@@ -8,6 +23,232 @@ except ImportError:
     except ImportError:
         raise ImportError('Photologue was unable to import the Python Imaging Library. Please confirm it`s installed and available on your current Python path.')
 
+try:
+    import ImageStat
+except ImportError:
+    from PIL import ImageStat
+
+# Weights of the channels in the luminance, as used by convert('L')
+LUMINANCE = (0.299, 0.587, 0.114)
+
+# Longer side of the reduced copy the mean luminance is measured on
+MEAN_SAMPLE_SIZE = 256
+
+
+class LRUCache(object):
+    """
+    A thread safe cache dropping the least recently used values, when the
+    total cost (e.g. the size in bytes) of the values exceeds max_cost.
+    Counts its hits and misses.
+    """
+    def __init__(self, max_cost):
+        self.max_cost = max_cost
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, cost = self._values.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Move to the end, as the most recently used
+            self._values[key] = (value, cost)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, cost=1):
+        if cost > self.max_cost:
+            # It would only push out everything else
+            return
+        with self._lock:
+            if key in self._values:
+                self.cost -= self._values.pop(key)[1]
+            self._values[key] = (value, cost)
+            self.cost += cost
+            while self.cost > self.max_cost:
+                old_key, (old_value, old_cost) = self._values.popitem(last=False)
+                self.cost -= old_cost
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self.cost = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'items': len(self._values), 'cost': self.cost}
+
+
+_key_locks = {}
+_key_locks_lock = threading.Lock()
+
+@contextmanager
+def key_lock(key):
+    """
+    Holds a lock for the key, the threads using the same key at the same time
+    wait for the first one. Locks are dropped when no thread uses them.
+    """
+    with _key_locks_lock:
+        lock, users = _key_locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _key_locks[key] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _key_locks_lock:
+            lock, users = _key_locks[key]
+            if users == 1:
+                del _key_locks[key]
+            else:
+                _key_locks[key] = (lock, users - 1)
+
+
+class FileLock(object):
+    """
+    An advisory lock of a file, shared by all processes on the host
+    (and by the hosts, if the file system supports it).
+
+    A lock held for longer than the timeout is considered stale, e.g. of
+    a hung process, and acquire() gives up waiting for it. Locks of dead
+    processes are released by the system.
+
+    The file is removed on release, so no lock files are left behind.
+    """
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.fd = None
+
+    def acquire(self):
+        """
+        Waits for the lock, returns False if it wasn't acquired because it is
+        stale, or because locking is not supported. The caller should then
+        continue without the lock.
+        """
+        if fcntl is None:
+            return False
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+            except OSError:
+                return False
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                os.close(fd)
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    return False
+                try:
+                    stale = time.time() - os.path.getmtime(self.path) > self.timeout
+                except OSError:
+                    stale = False
+                if stale or time.time() > deadline:
+                    return False
+                time.sleep(0.05)
+                continue
+            # The previous holder removes the file before unlocking it,
+            # a lock of a removed file is not the lock of the path
+            try:
+                opened = os.fstat(fd)
+                current = os.stat(self.path)
+            except OSError:
+                current = None
+            if current is None or (opened.st_dev, opened.st_ino) != (current.st_dev, current.st_ino):
+                os.close(fd)
+                continue
+            # The time of the acquisition, for the stale lock detection
+            os.utime(self.path, None)
+            self.fd = fd
+            return True
+
+    def release(self):
+        if self.fd is not None:
+            # Removed while still held, the waiting processes then lock a new file
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+def is_shared_cache(cache):
+    """
+    Checks if all processes see the same cache, which is not true
+    for the local memory and dummy caches.
+    """
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def image_cost(im):
+    """
+    Returns the approximate memory size of the PIL image, in bytes.
+    """
+    return im.size[0] * im.size[1] * len(im.getbands())
+
+
+def color_matrix(color=1.0, brightness=1.0, contrast=1.0, mean=0):
+    """
+    Returns the RGB conversion matrix doing the ImageEnhance Color, Brightness
+    and Contrast adjustments, in this order, with a single pass. The mean is
+    the mean luminance after the color and brightness adjustments, it is
+    needed for the contrast.
+    """
+    # Color mixes each channel with the luminance, which it keeps
+    rows = [[color * (i == j) + (1 - color) * LUMINANCE[j] for j in range(3)] for i in range(3)]
+    # Brightness scales the channels, contrast scales them around the mean
+    scale = brightness * contrast
+    offset = (1 - contrast) * int(mean + 0.5)
+    matrix = ()
+    for row in rows:
+        matrix += tuple(scale * value for value in row) + (offset,)
+    return matrix
+
+
+def adjusted_mean(im, color=1.0, brightness=1.0):
+    """
+    Returns the mean luminance of the RGB(A) image after the color and
+    brightness adjustments, which ImageEnhance.Contrast scales around.
+    It is measured on a reduced copy of the image.
+    """
+    if max(im.size) > MEAN_SAMPLE_SIZE:
+        scale = float(MEAN_SAMPLE_SIZE) / max(im.size)
+        im = im.resize((max(1, int(im.size[0] * scale)), max(1, int(im.size[1] * scale))), Image.BILINEAR)
+    im = im.convert('RGB').convert('RGB', color_matrix(color, brightness))
+    return ImageStat.Stat(im.convert('L')).mean[0]
+
+
+def adjust_colors(im, color=1.0, brightness=1.0, contrast=1.0, mean=None):
+    """
+    Returns the RGB(A) image with the color, brightness and contrast adjusted
+    like by ImageEnhance, but with a single pass over the image. The mean
+    for the contrast is measured on the image, unless it is given.
+    """
+    if color == brightness == contrast == 1.0:
+        return im
+    if contrast == 1.0:
+        mean = 0
+    elif mean is None:
+        mean = adjusted_mean(im, color, brightness)
+    matrix = color_matrix(color, brightness, contrast, mean)
+    if im.mode == 'RGBA':
+        alpha = im.split()[3]
+        im = im.convert('RGB').convert('RGB', matrix)
+        im.putalpha(alpha)
+        return im
+    return im.convert('RGB', matrix)
+
 
 def is_transparent(image):
     """
@@ -97,3 +97,305 @@ def get_moi_details(input):
         raise Exception("MOI details: unsupported MOI version %s in [%s]" % (b[0:2], fn))
     md["video_format"] = ord(b[128]) & 4
     return md
+
+
+# Container headers of the common video formats, read without spawning ffmpeg
+
+HEADER_READ = 64 * 1024
+
+# MPEG-1 pel aspect ratios (height/width of a pixel) by aspect ratio code
+MPG1_PEL_ASPECT = {
+    1: 1.0, 2: 0.6735, 3: 0.7031, 4: 0.7615, 5: 0.8055, 6: 0.8437, 7: 0.8935,
+    8: 0.9157, 9: 0.9815, 10: 1.0255, 11: 1.0695, 12: 1.0950, 13: 1.1575, 14: 1.2015,
+}
+# MPEG-2 display aspect ratios by aspect ratio code
+MPG2_DAR = {2: 4/3., 3: 16/9., 4: 2.21}
+MPG_PACK_HEADER = "\x00\x00\x01\xba"
+MPG_VIDEO_PES = "\x00\x00\x01\xe0"
+
+# Containers of ISO BMFF (mp4/mov) we descend into
+MP4_CONTAINERS = ("moov", "trak", "mdia", "minf", "stbl")
+
+EBML_HEADER = 0x1A45DFA3
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A966
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_DURATION = 0x4489
+EBML_TRACKS = 0x1654AE6B
+EBML_TRACK_ENTRY = 0xAE
+EBML_TRACK_TYPE = 0x83
+EBML_VIDEO = 0xE0
+EBML_PIXEL_WIDTH = 0xB0
+EBML_PIXEL_HEIGHT = 0xBA
+EBML_DISPLAY_WIDTH = 0x54B0
+EBML_DISPLAY_HEIGHT = 0x54BA
+
+def _video_info(width, height, display_w, display_h, duration):
+    """ (width, height, aspect, duration) as video_info returns them:
+    width scaled by the sample aspect ratio, duration in whole seconds
+    """
+    if not width or not height or duration is None:
+        return None
+    if not display_w or not display_h:
+        display_w, display_h = width, height
+    aspect = 1. * display_w / display_h
+    return (int(round(height * aspect)), height, aspect, int(round(duration)))
+
+def _mp4_boxes(fh, start, end):
+    """ iterate (type, payload offset, payload end) of the ISO BMFF boxes
+    between start and end, reading only the box headers
+    """
+    pos = start
+    while end is None or pos + 8 <= end:
+        fh.seek(pos)
+        header = fh.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        offset = pos + 8
+        if size == 1:
+            size = struct.unpack(">Q", fh.read(8))[0]
+            offset += 8
+        elif size == 0:
+            # Box extends to the end of the file
+            fh.seek(0, 2)
+            size = fh.tell() - pos
+        if size < offset - pos:
+            raise Exception("MP4 info: invalid box size")
+        yield kind, offset, pos + size
+        pos += size
+
+def get_mp4_info(fh):
+    """ get video details from the moov box of an mp4/mov file
+
+    @param fh:  file opened for binary reading
+    @return:    (width, height, aspect, duration) or None
+    """
+    fh.seek(4)
+    if fh.read(4) not in ("ftyp", "moov", "mdat", "wide", "free", "skip"):
+        return None
+    info = {}
+    def walk(start, end, track):
+        for kind, offset, box_end in _mp4_boxes(fh, start, end):
+            if kind in MP4_CONTAINERS:
+                if kind == "trak":
+                    track = {}
+                    walk(offset, box_end, track)
+                    if track.get("handler") == "vide" and "video" not in info:
+                        info["video"] = track
+                else:
+                    walk(offset, box_end, track)
+                continue
+            fh.seek(offset)
+            if kind == "mvhd":
+                b = fh.read(32)
+                if ord(b[0]) == 1:
+                    timescale, duration = struct.unpack(">IQ", b[20:32])
+                else:
+                    timescale, duration = struct.unpack(">II", b[12:20])
+                if timescale:
+                    info["duration"] = 1. * duration / timescale
+            elif kind == "tkhd":
+                b = fh.read(96)
+                # Presentation size, 16.16 fixed point, after the matrix
+                skip = 88 if ord(b[0]) == 1 else 76
+                w, h = struct.unpack(">II", b[skip:skip + 8])
+                track["display"] = (w >> 16, h >> 16)
+            elif kind == "hdlr" and "handler" not in track:
+                # QuickTime has a data handler in minf as well
+                track["handler"] = fh.read(12)[8:12]
+            elif kind == "stsd":
+                # First sample entry: size, format and the visual sample entry
+                b = fh.read(8 + 8 + 32)
+                if len(b) == 48:
+                    track["size"] = struct.unpack(">HH", b[40:44])
+                    # Pixel aspect ratio box follows the 78 bytes of the entry
+                    entry = offset + 8
+                    entry_end = entry + struct.unpack(">I", b[8:12])[0]
+                    for kind, child, child_end in _mp4_boxes(fh, entry + 8 + 78, min(entry_end, box_end)):
+                        if kind == "pasp":
+                            fh.seek(child)
+                            track["pasp"] = struct.unpack(">II", fh.read(8))
+    walk(0, None, None)
+    video = info.get("video")
+    if video is None or "size" not in video:
+        return None
+    display_w, display_h = video.get("display", (0, 0))
+    width, height = video["size"]
+    h_spacing, v_spacing = video.get("pasp", (0, 0))
+    if h_spacing and v_spacing:
+        display_w, display_h = width * h_spacing, height * v_spacing
+    return _video_info(width, height, display_w, display_h, info.get("duration"))
+
+def _ebml_vint(fh, keep_marker=False):
+    """ read an EBML variable length integer, None for unknown size """
+    first = fh.read(1)
+    if not first:
+        raise EOFError
+    value = ord(first)
+    length = 1
+    mask = 0x80
+    while length <= 8 and not value & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise Exception("EBML info: invalid variable length integer")
+    if not keep_marker:
+        value &= mask - 1
+    unknown = value == mask - 1
+    for c in fh.read(length - 1):
+        value = (value << 8) | ord(c)
+        unknown = unknown and ord(c) == 0xff
+    if unknown and not keep_marker:
+        return None
+    return value
+
+def _ebml_elements(fh, start, end):
+    """ iterate (id, payload offset, payload size) of the EBML elements
+    between start and end, reading only the element headers
+    """
+    pos = start
+    while end is None or pos < end:
+        fh.seek(pos)
+        try:
+            eid = _ebml_vint(fh, keep_marker=True)
+            size = _ebml_vint(fh)
+        except EOFError:
+            return
+        offset = fh.tell()
+        yield eid, offset, size
+        if size is None:
+            # Unknown size (live streams), we can't skip it
+            return
+        pos = offset + size
+
+def _ebml_uint(fh, size):
+    value = 0
+    for c in fh.read(size):
+        value = (value << 8) | ord(c)
+    return value
+
+def get_ebml_info(fh):
+    """ get video details from the Info and Tracks of a WebM/Matroska file
+
+    @param fh:  file opened for binary reading
+    @return:    (width, height, aspect, duration) or None
+    """
+    fh.seek(0)
+    if fh.read(4) != struct.pack(">I", EBML_HEADER):
+        return None
+    info = {"scale": 1000000}
+    for eid, offset, size in _ebml_elements(fh, 0, None):
+        if eid != EBML_SEGMENT:
+            continue
+        for eid, offset, size in _ebml_elements(fh, offset, offset + size if size is not None else None):
+            if eid == EBML_INFO:
+                for eid, offset, size in _ebml_elements(fh, offset, offset + size):
+                    fh.seek(offset)
+                    if eid == EBML_TIMECODE_SCALE:
+                        info["scale"] = _ebml_uint(fh, size)
+                    elif eid == EBML_DURATION:
+                        info["duration"] = struct.unpack(">f" if size == 4 else ">d", fh.read(size))[0]
+            elif eid == EBML_TRACKS:
+                for eid, offset, size in _ebml_elements(fh, offset, offset + size):
+                    if eid != EBML_TRACK_ENTRY or "video" in info:
+                        continue
+                    track = {}
+                    for eid, offset, size in _ebml_elements(fh, offset, offset + size):
+                        fh.seek(offset)
+                        if eid == EBML_TRACK_TYPE:
+                            track["type"] = _ebml_uint(fh, size)
+                        elif eid == EBML_VIDEO:
+                            for eid, offset, size in _ebml_elements(fh, offset, offset + size):
+                                fh.seek(offset)
+                                track[eid] = _ebml_uint(fh, size)
+                    if track.get("type") == 1:
+                        info["video"] = track
+            if "video" in info and "duration" in info:
+                break
+        break
+    video = info.get("video")
+    if video is None or "duration" not in info:
+        return None
+    # Only the ratio of the display size is used, so its unit doesn't matter
+    display_w, display_h = video.get(EBML_DISPLAY_WIDTH), video.get(EBML_DISPLAY_HEIGHT)
+    return _video_info(video.get(EBML_PIXEL_WIDTH), video.get(EBML_PIXEL_HEIGHT),
+                display_w, display_h, info["duration"] * info["scale"] / 1e9)
+
+def _mpg_pts(b):
+    """ presentation time stamps (90kHz) of the video PES packets in b """
+    pts = []
+    i = b.find(MPG_VIDEO_PES)
+    while i >= 0 and i + 19 <= len(b):
+        j = i + 6
+        if ord(b[j]) & 0xc0 == 0x80:
+            # MPEG-2 PES header, PTS follows the flags and header length
+            j = j + 3 if ord(b[j + 1]) & 0x80 else None
+        else:
+            # MPEG-1 packet, skip stuffing and buffer size
+            while j < i + 22 and b[j] == "\xff":
+                j += 1
+            if ord(b[j]) & 0xc0 == 0x40:
+                j += 2
+            if ord(b[j]) & 0xe0 != 0x20:
+                j = None
+        if j is not None:
+            c = [ord(x) for x in b[j:j + 5]]
+            if len(c) == 5:
+                pts.append(((c[0] >> 1) & 7) << 30 | c[1] << 22 | (c[2] >> 1) << 15 | c[3] << 7 | c[4] >> 1)
+        i = b.find(MPG_VIDEO_PES, i + 4)
+    return pts
+
+def get_mpg_info(fh):
+    """ get video details from the sequence header and the video packets
+    of a MPEG program stream
+
+    The duration is the span of the video presentation time stamps,
+    only the start and the end of the file are read.
+
+    @param fh:  file opened for binary reading
+    @return:    (width, height, aspect, duration) or None
+    """
+    fh.seek(0)
+    head = fh.read(HEADER_READ)
+    if not head.startswith(MPG_PACK_HEADER):
+        return None
+    mpeg2 = ord(head[4]) & 0xc0 == 0x40
+    i = head.find(MPG_SEQ_HEADER)
+    if i < 0 or len(head) < i + 8:
+        return None
+    b4, b5, b6, b7 = [ord(c) for c in head[i + 4:i + 8]]
+    width = (b4 << 4) | (b5 >> 4)
+    height = ((b5 & 0x0f) << 8) | b6
+    code = b7 >> 4
+    if mpeg2:
+        display_w, display_h = (MPG2_DAR[code], 1.) if code in MPG2_DAR else (width, height)
+    else:
+        display_w, display_h = (width / MPG1_PEL_ASPECT.get(code, 1.), height)
+
+    fh.seek(0, 2)
+    end = fh.tell()
+    fh.seek(max(0, end - HEADER_READ))
+    tail = fh.read(HEADER_READ)
+    first = _mpg_pts(head)
+    last = _mpg_pts(tail)
+    if not first or not last or max(last) < min(first):
+        return None
+    return _video_info(width, height, display_w, display_h, (max(last) - min(first)) / 90000.)
+
+def get_video_info(fn):
+    """ get video details from the container headers without ffmpeg
+
+    Supports ISO BMFF (mp4, mov), EBML (WebM, Matroska) and MPEG program
+    streams.
+
+    @param fn:  video file name
+    @return:    (width, height, aspect, duration) as video_info returns
+                them, or None for unknown containers
+    """
+    with open(fn, "rb") as fh:
+        for parser in (get_mp4_info, get_ebml_info, get_mpg_info):
+            info = parser(fh)
+            if info is not None:
+                return info
+    return None
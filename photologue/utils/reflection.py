@@ -40,6 +40,33 @@ except ImportError:
     except ImportError:
         raise ImportError("The Python Imaging Library was not found.")
 
+from photologue.utils import LRUCache
+
+# Gradient masks by (opacity, amount, width, height), up to this many bytes
+MASK_CACHE_SIZE = 16 * 2 ** 20
+mask_cache = LRUCache(MASK_CACHE_SIZE)
+
+
+def gradient_mask(opacity, amount, width, height):
+    """ Returns the alpha mask of the reflection of an image of the given size,
+    from the reflected edge to the end of the reflection.
+
+    """
+    key = (opacity, amount, width, height)
+    mask = mask_cache.get(key)
+    if mask is not None:
+        return mask
+    start = int(255 - (255 * opacity)) # The start of our gradient
+    steps = int(255 * amount) # the number of intermedite values
+    increment = (255 - start) / float(steps)
+    gradient = Image.new('L', (1, 255))
+    gradient.putdata([int(y * increment + start) if y < steps else 255 for y in range(255)])
+    # Stretched over the whole image height, only the reflected part is kept
+    reflection_height = int(height * amount)
+    mask = gradient.resize((1, height)).crop((0, 0, 1, reflection_height)).resize((width, reflection_height))
+    mask_cache.set(key, mask, width * reflection_height)
+    return mask
+
 
 def add_reflection(im, bgcolor="#00000", amount=0.4, opacity=0.6):
     """ Returns the supplied PIL Image (im) with a reflection effect
@@ -55,31 +82,16 @@ def add_reflection(im, bgcolor="#00000", amount=0.4, opacity=0.6):
     # convert bgcolor string to rgb value
     background_color = ImageColor.getrgb(bgcolor)
 
-    # copy orignial image and flip the orientation
-    reflection = im.copy().transpose(Image.FLIP_TOP_BOTTOM)
-
-    # create a new image filled with the bgcolor the same size
-    background = Image.new("RGB", im.size, background_color)
-
-    # calculate our alpha mask
-    start = int(255 - (255 * opacity)) # The start of our gradient
-    steps = int(255 * amount) # the number of intermedite values
-    increment = (255 - start) / float(steps)
-    mask = Image.new('L', (1, 255))
-    for y in range(255):
-        if y < steps:
-            val = int(y * increment + start)
-        else:
-            val = 255
-        mask.putpixel((0, y), val)
-    alpha_mask = mask.resize(im.size)
-
-    # merge the reflection onto our background color using the alpha mask
-    reflection = Image.composite(background, reflection, alpha_mask)
-
-    # crop the reflection
+    # only the reflected strip at the bottom is flipped
     reflection_height = int(im.size[1] * amount)
-    reflection = reflection.crop((0, 0, im.size[0], reflection_height))
+    reflection = im.crop((0, im.size[1] - reflection_height, im.size[0], im.size[1]))
+    reflection = reflection.transpose(Image.FLIP_TOP_BOTTOM)
+    if reflection.mode != 'RGB':
+        reflection = reflection.convert('RGB')
+
+    # merge the bgcolor into the reflection using the alpha mask
+    alpha_mask = gradient_mask(opacity, amount, im.size[0], im.size[1])
+    reflection.paste(background_color, (0, 0) + reflection.size, alpha_mask)
 
     # create new image sized to hold both the original image and the reflection
     composite = Image.new("RGB", (im.size[0], im.size[1]+reflection_height), background_color)
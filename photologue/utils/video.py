@@ -2,11 +2,13 @@ import sys, os, subprocess, re, shlex, string
 from datetime import datetime, timedelta, time
 from base64 import b64decode
 from tempfile import mktemp
+from glob import glob
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from django.core.files.temp import NamedTemporaryFile
 from django.core.files import File
 from photologue.default_settings import *
+from photologue.utils.libmc import get_video_info
 
 FFMPEG = getattr(settings, 'PHOTOLOGUE_FFMPEG', 'ffmpeg')
 QTFAST = getattr(settings, 'PHOTOLOGUE_QTFAST', 'qt-faststart')
@@ -18,6 +20,14 @@ AUDIO_OGG = getattr(settings, 'PHOTOLOGUE_AUDIO_OGG', 'libvorbis')
 AUDIO_SAMPLING_RATE = getattr(settings, 'PHOTOLOGUE_AUDIO_SAMPLING_RATE', 22050)
 
 def video_info(video_file):
+    # Read the container headers, ffmpeg is needed only for unknown formats
+    try:
+        info = get_video_info(video_file)
+    except Exception:
+        info = None
+    if info is not None:
+        return info
+
     count = 0
     indata = ""
     while count < 5:
@@ -93,15 +103,65 @@ def construct_filter(*args):
         return '-vf ' + f
     return ''
 
-def execute(command, header):
+def ffmpeg_progress(report, duration, step=1, steps=1):
+    ''' Translate the ffmpeg -progress output into calls of
+        report(percent, fps, eta), eta being the seconds left
+
+        The run is the step of steps passes over the video.
+    '''
+
+    if report is None:
+        return None
+
+    def progress(values):
+        try:
+            # out_time_ms is in microseconds as well
+            out_time = int(values.get('out_time_us', values.get('out_time_ms'))) / 1000000.
+        except (TypeError, ValueError):
+            out_time = 0
+        if values.get('progress') == 'end':
+            out_time = duration
+        fraction = min(out_time / duration, 1.) if duration else 0.
+        try:
+            fps = float(values['fps']) or None
+        except (KeyError, ValueError):
+            fps = None
+        try:
+            speed = float(values.get('speed', '').rstrip('x'))
+        except ValueError:
+            speed = 0
+        if speed > 0:
+            eta = (steps - step + 1 - fraction) * duration / speed
+        else:
+            eta = None
+        report(100. * (step - 1 + fraction) / steps, fps, eta)
+    return progress
+
+def execute(command, header, progress=None):
     print header
     print "Command: %s\n" % command
 
-    child = subprocess.Popen(shlex.split(str(command)), stdout=subprocess.PIPE, preexec_fn=lambda : os.nice(20))
+    args = shlex.split(str(command))
+    if progress is not None:
+        # Let ffmpeg write machine readable progress to stdout
+        args[1:1] = ['-nostats', '-progress', 'pipe:1']
+    child = subprocess.Popen(args, stdout=subprocess.PIPE, preexec_fn=lambda : os.nice(20))
 
     msg = header + "\n"
     msg += "Command: %s\n" % command
-    msg += reduce(lambda i, s: i + s + "\n", child.stdout.readlines(), "")
+    values = {}
+    # Read the output as it comes, not after the process ends
+    for line in iter(child.stdout.readline, ''):
+        key, sep, value = line.strip().partition('=')
+        if progress is None or not sep:
+            msg += line + "\n"
+            continue
+        values[key] = value
+        # Each block of progress values ends with progress=continue/end
+        if key == 'progress':
+            progress(values)
+            values = {}
+    child.wait()
     msg += "Returncode: %d\n" % (child.returncode if child.returncode else 0)
 
     return (msg, child.returncode)
@@ -190,7 +250,8 @@ def convertvideo_flv(video_in, video_out, video_data):
     output += "Source : %s\n" % video_in
     output += "Target : %s\n" % video_out
 
-    (message, retval) = execute(ffmpeg, "------------------ FFMPEG : FLV ----------------")
+    (message, retval) = execute(ffmpeg, "------------------ FFMPEG : FLV ----------------",
+                                ffmpeg_progress(video_data.get('progress'), video_data['duration']))
     output += message
     if retval:
         raise Exception('FLV creation have failed(ffmpeg)\n\n' + output)
@@ -236,11 +297,13 @@ def convertvideo_mp4(video_in, video_out, video_data):
                             )
     
         if video_data['twopass']:
-            original_files = os.listdir('.') # used later for cleanup
+            # Unique log name, other conversions may run in parallel
+            passlog = mktemp(prefix='photologue-2pass-')
             ffmpeg = (  '%(ffmpeg)s -y -i "%(source)s" %(common)s '
-                        '-pass 1 %(audio)s -f mp4 %(outfile)s'
+                        '-pass 1 -passlogfile %(passlog)s %(audio)s -f mp4 %(outfile)s'
                         ) % dict(
                             ffmpeg=FFMPEG,
+                            passlog=passlog,
                             source=video_in,
                             common=common_options,
                             audio=audio_pass1,
@@ -250,7 +313,8 @@ def convertvideo_mp4(video_in, video_out, video_data):
             output += "Source : %s\n" % video_in
             output += "Target : %s\n" % video_out
     
-            (message, retval) = execute(ffmpeg, "------------- FFMPEG : MP4 : Pass1 -------------")
+            (message, retval) = execute(ffmpeg, "------------- FFMPEG : MP4 : Pass1 -------------",
+                                        ffmpeg_progress(video_data.get('progress'), video_data['duration'], 1, 2))
             output += message
             if retval:
                 raise Exception('MP4 creation have failed(pass 1)\n\n' + output)
@@ -261,7 +325,7 @@ def convertvideo_mp4(video_in, video_out, video_data):
                         ffmpeg=FFMPEG,
                         source=video_in,
                         common=common_options,
-                        twopass='-pass 2' if video_data['twopass'] else '',
+                        twopass='-pass 2 -passlogfile %s' % passlog if video_data['twopass'] else '',
                         audio=audio_pass2,
                         outfile=video_out,
                     )
@@ -271,7 +335,9 @@ def convertvideo_mp4(video_in, video_out, video_data):
     
         header = ("------------- FFMPEG : MP4 : Pass2 -------------" if video_data['twopass'] else
                   "----------------- FFMPEG : MP4 -----------------")
-        (message, retval) = execute(ffmpeg, header)
+        passes = 2 if video_data['twopass'] else 1
+        (message, retval) = execute(ffmpeg, header,
+                                    ffmpeg_progress(video_data.get('progress'), video_data['duration'], passes, passes))
         output += message
         if retval:
             raise Exception('MP4 creation have failed(final pass)\n\n' + output)
@@ -298,8 +364,7 @@ def convertvideo_mp4(video_in, video_out, video_data):
     finally:
         if video_data['twopass']:
             # Cleanup our 2-pass logfiles
-            logs = filter(lambda x: x.endswith('.log') and '2pass' in x, set(os.listdir('.'))-set(original_files))
-            for log in logs:
+            for log in glob(passlog + '*'):
                 os.unlink(log)
     return output
 
@@ -325,7 +390,8 @@ def convertvideo_ogv(video_in, video_out, video_data):
     output += "Source : %s\n" % video_in
     output += "Target : %s\n" % video_out
 
-    (message, retval) = execute(ffmpeg, "------------------ FFMPEG : OGV ----------------")
+    (message, retval) = execute(ffmpeg, "------------------ FFMPEG : OGV ----------------",
+                                ffmpeg_progress(video_data.get('progress'), video_data['duration']))
     output += message
     if retval:
         raise Exception('OGV creation have failed\n\n' + output)
@@ -365,11 +431,13 @@ def convertvideo_webm(video_in, video_out, video_data):
                             )
     
         if video_data['twopass']:
-            original_files = os.listdir('.') # used later for cleanup
+            # Unique log name, other conversions may run in parallel
+            passlog = mktemp(prefix='photologue-2pass-')
             ffmpeg = (  '%(ffmpeg)s -y -i "%(source)s" %(common)s '
-                        '-pass 1 %(audio)s -f webm %(outfile)s'
+                        '-pass 1 -passlogfile %(passlog)s %(audio)s -f webm %(outfile)s'
                         ) % dict(
                             ffmpeg=FFMPEG,
+                            passlog=passlog,
                             source=video_in,
                             common=common_options,
                             audio=audio_pass1,
@@ -378,7 +446,8 @@ def convertvideo_webm(video_in, video_out, video_data):
             output += "Source : %s\n" % video_in
             output += "Target : %s\n" % video_out
     
-            (message, retval) = execute(ffmpeg, "------------- FFMPEG : WEBM : Pass1 -------------")
+            (message, retval) = execute(ffmpeg, "------------- FFMPEG : WEBM : Pass1 -------------",
+                                        ffmpeg_progress(video_data.get('progress'), video_data['duration'], 1, 2))
             output += message
             if retval:
                 raise Exception('WEBM creation have failed(pass 1)\n\n' + output)
@@ -389,7 +458,7 @@ def convertvideo_webm(video_in, video_out, video_data):
                         ffmpeg=FFMPEG,
                         source=video_in,
                         common=common_options,
-                        twopass='-pass 2' if video_data['twopass'] else '',
+                        twopass='-pass 2 -passlogfile %s' % passlog if video_data['twopass'] else '',
                         audio=audio_pass2,
                         outfile=video_out,
                     )
@@ -399,7 +468,9 @@ def convertvideo_webm(video_in, video_out, video_data):
     
         header = ("------------- FFMPEG : WEBM : Pass2 -------------" if video_data['twopass'] else
                   "----------------- FFMPEG : WEBM -----------------")
-        (message, retval) = execute(ffmpeg, header)
+        passes = 2 if video_data['twopass'] else 1
+        (message, retval) = execute(ffmpeg, header,
+                                    ffmpeg_progress(video_data.get('progress'), video_data['duration'], passes, passes))
         output += message
         if retval:
             raise Exception('WEBM creation have failed(final pass)\n\n' + output)
@@ -413,7 +484,138 @@ def convertvideo_webm(video_in, video_out, video_data):
     finally:
         if video_data['twopass']:
             # Cleanup our 2-pass logfiles
-            logs = filter(lambda x: x.endswith('.log') and '2pass' in x, set(os.listdir('.'))-set(original_files))
-            for log in logs:
+            for log in glob(passlog + '*'):
                 os.unlink(log)
     return output
+
+# Encoder options of the types convertvideo_batch can produce in one run
+BATCH_VIDEO_TYPES = ('mp4', 'webm', 'ogv')
+BATCH_FORMATS = {
+    'mp4': 'mp4',
+    'webm': 'webm',
+    'ogv': 'ogg',
+}
+BATCH_VIDEO_OPTIONS = {
+    'mp4': ('-vcodec libx264 -vprofile high -preset slower -b:v %(vb)dk '
+            '-maxrate %(vb)dk -bufsize %(bfs)dk -threads 0'),
+    'webm': ('-codec:v libvpx -vpre libvpx-360p -quality good -cpu-used 0 -b:v %(vb)dk -qmin 10 -qmax 42 '
+             '-maxrate %(vb)dk -bufsize %(bfs)dk -threads 2'),
+    'ogv': '-b:v %(vb)dk -vcodec libtheora',
+}
+BATCH_AUDIO_OPTIONS = {
+    'mp4': '-acodec ' + AUDIO_AAC + ' -ar 44100 -b:a %(ab)dk',
+    'webm': '-codec:a ' + AUDIO_OGG + ' -ar 44100 -b:a %(ab)dk',
+    'ogv': '-acodec libvorbis',
+}
+
+def batch_filter_graph(datas):
+    ''' Build a filter graph decoding the input once and splitting it
+        into one labeled stream ([v0], [v1], ...) per output
+    '''
+
+    deinterlace = set(video_data['deinterlace'] for video_data in datas)
+    # Deinterlace before the split when all the outputs agree
+    common = deinterlace.pop() if len(deinterlace) == 1 else None
+    graph = '[0:v]%ssplit=%d%s' % (
+                common + ',' if common else '',
+                len(datas),
+                ''.join('[s%d]' % i for i in range(len(datas))),
+            )
+    for i, video_data in enumerate(datas):
+        chain = [video_data['deinterlace'] if common is None else '',
+                 video_data.get('letterboxing', '').replace('"', ''),
+                 'scale=%d:%d' % video_data['size']]
+        graph += ';[s%d]%s[v%d]' % (i, ','.join(f for f in chain if f), i)
+    return "-filter_complex '%s'" % graph
+
+def convertvideo_batch(video_in, outputs, progress=None):
+    ''' Convert the video to several outputs with a single decode
+
+        outputs is a list of (videotype, video_out, video_data) with videotype
+        one of BATCH_VIDEO_TYPES. Returns the log and a list with the error
+        of each output (None if it was created). Failure of ffmpeg itself
+        raises an exception, as it fails all the outputs. Progress of the
+        run is reported as in ffmpeg_progress.
+    '''
+
+    output = "Source : %s\n" % video_in
+    for videotype, video_out, video_data in outputs:
+        output += "Target : %s\n" % video_out
+    duration = outputs[0][2]['duration']
+    passlogs = {}
+    try:
+        # First pass of all two-pass outputs in one run
+        twopass = [i for i, (videotype, video_out, video_data) in enumerate(outputs)
+                   if video_data['twopass'] and videotype != 'ogv']
+        if twopass:
+            nul = '/dev/null' if os.path.exists('/dev/null') else 'NUL'
+            ffmpeg = '%s -y -i "%s" %s' % (FFMPEG, video_in,
+                        batch_filter_graph([outputs[i][2] for i in twopass]))
+            for n, i in enumerate(twopass):
+                videotype, video_out, video_data = outputs[i]
+                # Unique log name, other conversions may run in parallel
+                passlogs[i] = mktemp(prefix='photologue-2pass-')
+                ffmpeg += ' -map [v%d] %s -pass 1 -passlogfile %s -an -f %s %s' % (
+                            n,
+                            BATCH_VIDEO_OPTIONS[videotype] % dict(
+                                vb=video_data['videobitrate'],
+                                bfs=2*video_data['videobitrate']),
+                            passlogs[i],
+                            BATCH_FORMATS[videotype],
+                            nul,
+                        )
+            (message, retval) = execute(ffmpeg, "------------- FFMPEG : BATCH : Pass1 -------------",
+                                        ffmpeg_progress(progress, duration, 1, 2))
+            output += message
+            if retval:
+                raise Exception('Batch conversion have failed(pass 1)\n\n' + output)
+
+        ffmpeg = '%s -y -i "%s" %s' % (FFMPEG, video_in,
+                    batch_filter_graph([video_data for videotype, video_out, video_data in outputs]))
+        for i, (videotype, video_out, video_data) in enumerate(outputs):
+            if videotype == 'ogv' or video_data['audiobitrate']:
+                audio = '-map 0:a? ' + BATCH_AUDIO_OPTIONS[videotype] % dict(ab=video_data['audiobitrate'])
+            else:
+                audio = '-an'
+            ffmpeg += ' -map [v%d] %s %s %s -f %s %s' % (
+                        i,
+                        BATCH_VIDEO_OPTIONS[videotype] % dict(
+                            vb=video_data['videobitrate'],
+                            bfs=2*video_data['videobitrate']),
+                        '-pass 2 -passlogfile %s' % passlogs[i] if i in passlogs else '',
+                        audio,
+                        BATCH_FORMATS[videotype],
+                        video_out,
+                    )
+        header = ("------------- FFMPEG : BATCH : Pass2 -------------" if passlogs else
+                  "----------------- FFMPEG : BATCH -----------------")
+        passes = 2 if passlogs else 1
+        (message, retval) = execute(ffmpeg, header, ffmpeg_progress(progress, duration, passes, passes))
+        output += message
+        if retval:
+            raise Exception('Batch conversion have failed(final pass)\n\n' + output)
+    finally:
+        # Cleanup our 2-pass logfiles
+        for passlog in passlogs.values():
+            for log in glob(passlog + '*'):
+                os.unlink(log)
+
+    errors = []
+    for videotype, video_out, video_data in outputs:
+        try:
+            if videotype == 'mp4':
+                # Move moov to start
+                tmp = video_out + '_fast'
+                qtfast = '%s %s %s' % (QTFAST, video_out, tmp)
+                (message, retval) = execute(qtfast, "------------- QT-FASTSTART : MP4  -------------")
+                output += message
+                if retval:
+                    raise Exception('QT-FASTSTART failed\n\n' + output)
+                os.rename(tmp, video_out)
+            if os.stat(video_out).st_size == 0:
+                output += "Target file %s is 0 bytes conversion failed?\n" % video_out
+                raise Exception('%s creation have failed(file zero size)\n\n' % videotype.upper() + output)
+            errors.append(None)
+        except Exception, e:
+            errors.append(e)
+    return (output, errors)
@@ -0,0 +1,118 @@
+""" Buffered view counting.
+
+Views are counted in memory, or in the cache when it is shared by all
+processes (e.g. memcached), and written to the database with one UPDATE
+per distinct count, after PHOTOLOGUE_VIEW_COUNT_INTERVAL seconds, when
+PHOTOLOGUE_VIEW_COUNT_MAX_PENDING objects have pending views, or when the
+process exits. Views counted in a shared cache can also be written by the
+plflushviews command, e.g. the views of processes which were killed.
+
+"""
+import atexit
+import threading
+import time
+from django.core.cache import get_cache
+from django.db import DatabaseError
+from django.db.models import F
+
+from photologue.default_settings import *
+from photologue.utils import is_shared_cache
+
+VIEW_COUNT_KEY = 'photologue-views-%d'
+
+_lock = threading.Lock()
+_pending = set()
+# Views counted by this process, when the cache is not shared
+_counts = {}
+_last_flush = [time.time()]
+
+def view_cache():
+    return get_cache(PHOTOLOGUE_VIEW_COUNT_CACHE)
+
+def add_views(cache, key, count):
+    # add() is atomic, it fails when the counter exists already
+    if not cache.add(key, count, PHOTOLOGUE_VIEW_COUNT_TIMEOUT):
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            # Expired meanwhile
+            cache.add(key, count, PHOTOLOGUE_VIEW_COUNT_TIMEOUT)
+
+def increment(media_id):
+    """ Counts one view of the MediaModel with the given id. """
+    cache = view_cache()
+    shared = is_shared_cache(cache)
+    if shared:
+        add_views(cache, VIEW_COUNT_KEY % media_id, 1)
+    with _lock:
+        if not shared:
+            _counts[media_id] = _counts.get(media_id, 0) + 1
+        _pending.add(media_id)
+        due = len(_pending) >= PHOTOLOGUE_VIEW_COUNT_MAX_PENDING or \
+              time.time() - _last_flush[0] >= PHOTOLOGUE_VIEW_COUNT_INTERVAL
+    if due:
+        try:
+            flush()
+        except DatabaseError:
+            # The counts are kept for the next flush,
+            # the page being viewed is not broken by them
+            pass
+
+def flush(media_ids=None):
+    """
+    Writes the counted views of the given MediaModel ids to the database,
+    by default of all objects viewed by this process since the last flush.
+    Returns the number of views written. If writing fails, the views not
+    written are counted again and the error is raised.
+    """
+    from photologue.models import MediaModel
+    with _lock:
+        if media_ids is None:
+            media_ids = list(_pending)
+        _pending.difference_update(media_ids)
+        _last_flush[0] = time.time()
+        local = dict((media_id, _counts.pop(media_id)) for media_id in media_ids if media_id in _counts)
+    if not media_ids:
+        return 0
+    # Group the objects by count, so each count needs a single UPDATE
+    counts = {}
+    for media_id, value in local.items():
+        counts.setdefault(value, []).append(media_id)
+    cache = view_cache()
+    if is_shared_cache(cache):
+        keys = dict((VIEW_COUNT_KEY % media_id, media_id) for media_id in media_ids)
+        for key, value in cache.get_many(keys.keys()).items():
+            if not value:
+                continue
+            # Views counted meanwhile stay in the cache for the next flush
+            try:
+                cache.decr(key, value)
+            except ValueError:
+                continue
+            counts.setdefault(value, []).append(keys[key])
+    total = 0
+    counts = counts.items()
+    for index, (value, ids) in enumerate(counts):
+        try:
+            MediaModel.objects.filter(id__in=ids).update(view_count=F('view_count') + value)
+        except DatabaseError:
+            restore(counts[index:], local, cache)
+            raise
+        total += value * len(ids)
+    return total
+
+def restore(counts, local, cache):
+    """
+    Counts again the views which were not written.
+    """
+    with _lock:
+        for value, ids in counts:
+            for media_id in ids:
+                if media_id in local:
+                    _counts[media_id] = _counts.get(media_id, 0) + value
+                else:
+                    add_views(cache, VIEW_COUNT_KEY % media_id, value)
+            _pending.update(ids)
+
+# Do not lose the views counted by this process
+atexit.register(flush)
@@ -27,31 +27,57 @@ def reduce_opacity(im, opacity):
     im.putalpha(alpha)
     return im
 
-def apply_watermark(im, mark, position, opacity=1):
-    """Adds a watermark to an image."""
+def prepare_mark(mark, opacity=1):
+    """Returns the watermark ready to be drawn, with reduced opacity."""
     if opacity < 1:
-        mark = reduce_opacity(mark, opacity)
-    if im.mode != 'RGBA':
-        im = im.convert('RGBA')
-    # create a transparent layer the size of the image and draw the
-    # watermark in that layer.
-    layer = Image.new('RGBA', im.size, (0,0,0,0))
+        return reduce_opacity(mark, opacity)
+    return mark
+
+def watermark_layer(size, mark, position):
+    """
+    Returns a transparent layer of the given size with the (prepared)
+    watermark drawn in it. The layer can be reused for all images
+    of the same size.
+    """
+    layer = Image.new('RGBA', size, (0,0,0,0))
     if position == 'tile':
-        for y in range(0, im.size[1], mark.size[1]):
-            for x in range(0, im.size[0], mark.size[0]):
-                layer.paste(mark, (x, y))
+        # Tile one row, then the rows
+        row = Image.new('RGBA', (size[0], mark.size[1]), (0,0,0,0))
+        for x in range(0, size[0], mark.size[0]):
+            row.paste(mark, (x, 0))
+        for y in range(0, size[1], mark.size[1]):
+            layer.paste(row, (0, y))
     elif position == 'scale':
         # scale, but preserve the aspect ratio
         ratio = min(
-            float(im.size[0]) / mark.size[0], float(im.size[1]) / mark.size[1])
+            float(size[0]) / mark.size[0], float(size[1]) / mark.size[1])
         w = int(mark.size[0] * ratio)
         h = int(mark.size[1] * ratio)
         mark = mark.resize((w, h))
-        layer.paste(mark, ((im.size[0] - w) / 2, (im.size[1] - h) / 2))
+        layer.paste(mark, ((size[0] - w) / 2, (size[1] - h) / 2))
     else:
         layer.paste(mark, position)
+    return layer
+
+def composite_layer(im, layer):
+    """Composites the watermark layer with the image."""
+    mode = im.mode
+    if mode != 'RGBA':
+        im = im.convert('RGBA')
+    im = Image.composite(layer, im, layer)
+    # Keep the mode, newer PIL versions refuse to save RGBA as JPEG
+    if mode != 'RGBA':
+        im = im.convert(mode)
+    return im
+
+def apply_watermark(im, mark, position, opacity=1):
+    """Adds a watermark to an image."""
+    mark = prepare_mark(mark, opacity)
+    # create a transparent layer the size of the image and draw the
+    # watermark in that layer.
+    layer = watermark_layer(im.size, mark, position)
     # composite the watermark with the layer
-    return Image.composite(layer, im, layer)
+    return composite_layer(im, layer)
 
 def test():
     im = Image.open('test.png')
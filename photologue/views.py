@@ -1,11 +1,14 @@
+import mimetypes
 from django import forms
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.utils import simplejson as json
-from django.core.exceptions import ViewDoesNotExist
+from django.core.exceptions import ViewDoesNotExist, ObjectDoesNotExist
 from django.views.generic.date_based import archive_index
 
 from forms import AjaxRequestForm
-from models import Photo
+from models import Photo, ImageModel, MediaSizeCache, media_models, media_queryset
+from photologue.default_settings import *
+from photologue.utils import key_lock
 
 def media_meta(request, view, **kwargs):
     if callable(view):
@@ -68,3 +71,52 @@ def ajax_archive_index(request, **kwargs):
     if request.is_ajax():
         return ajax_view(request)
     return archive_index(request, **kwargs)
+
+def rendition_queryset(request, model):
+    """
+    Returns the objects of the media model whose sizes can be served to the
+    user, only staff can see private items and posters of private videos.
+    """
+    queryset = media_queryset(model)
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return queryset
+    if 'is_public' in model._meta.get_all_field_names():
+        queryset = queryset.filter(is_public=True)
+    elif issubclass(model, ImageModel):
+        queryset = queryset.exclude(videomodel__video__is_public=False)
+    return queryset
+
+def rendition(request, model, pk, size):
+    """
+    Creates the size of the media object if it doesn't exist yet and serves it.
+    Concurrent requests for the same size wait for the first one to create it.
+    """
+    classes = dict((cls._meta.object_name.lower(), cls) for cls in media_models())
+    if model not in classes:
+        raise Http404
+    try:
+        obj = rendition_queryset(request, classes[model]).get(pk=pk)
+    except ObjectDoesNotExist:
+        raise Http404
+    mediasize = MediaSizeCache().sizes.get(size)
+    if mediasize is None or not obj.file or not obj.size_applies(mediasize):
+        raise Http404
+    fingerprint = obj.size_fingerprint(mediasize)
+    if not obj.size_exists(mediasize, fingerprint):
+        with key_lock((model, obj.pk, size)):
+            # Created meanwhile by the request we waited for
+            if not obj.size_exists(mediasize, fingerprint):
+                obj.create_size(mediasize)
+        if not obj.size_exists(mediasize, fingerprint):
+            raise Http404
+    url = '/'.join([obj.cache_url(), obj._get_filename_for_size(mediasize, fingerprint)])
+    if PHOTOLOGUE_RENDITION_SERVE == 'redirect':
+        return HttpResponseRedirect(url)
+    filename = getattr(obj, 'get_%s_filename' % size)()
+    response = HttpResponse(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if PHOTOLOGUE_RENDITION_SERVE == 'X-Accel-Redirect':
+        response['X-Accel-Redirect'] = url
+    else:
+        response[PHOTOLOGUE_RENDITION_SERVE] = filename
+    return response
@@ -1,3 +1,4 @@
+import os
 from tempfile import mkdtemp
 
 DEBUG = True
@@ -12,8 +13,15 @@ DATABASES = {
 ROOT_URLCONF = 'photologue.urls'
 
 INSTALLED_APPS = (
+    'django.contrib.auth',
     'django.contrib.contenttypes',
+    'taggit',
     'photologue',
 )
 
 MEDIA_ROOT = mkdtemp()
+
+# The dates taken from EXIF and video file names are time zone aware
+USE_TZ = True
+
+SAMPLE_IMAGE_PATH = os.path.join(os.path.dirname(__file__), 'photologue', 'res', 'sample.jpg')